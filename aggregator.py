@@ -0,0 +1,348 @@
+"""
+Edge-to-central forwarding.
+
+Edge instances (see dataloggers.ForwardLogger) send batches of readings as compact, zlib-compressed frames to a
+central instance, over TCP or MQTT. The central AggregatorServer deduplicates frames by site and sequence number and
+writes the readings to InfluxDB in large batches. Centrals scale horizontally by site: every site belongs to shard
+site_shard(site, shard_count), and each central only accepts the sites of its own shard.
+
+Frame: header (magic, version, site length, boot ID, sequence number, reading count), site, zlib(JSON readings).
+Readings in a frame: [prefix, topic, tag, value, timestamp (UNIX epoch, nanoseconds)]. Version 1 frames (timestamps
+in seconds, from older edges) are still accepted.
+Over TCP, every frame is prefixed with its length and answered with an ack (status, sequence number). A central whose
+buffer is full (InfluxDB unreachable) answers ACK_BUSY, so the edge keeps the frame and retries it later. Over MQTT,
+the central disconnects from the broker instead, which keeps the frames of its persistent session until it is back.
+"""
+import json
+import time
+import zlib
+import struct
+import logging
+import threading
+import socketserver
+from itertools import islice
+from collections import deque
+
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
+import paho.mqtt.client as mqtt
+
+import lineprotocol
+from series import get_registry
+
+logger = logging.getLogger(__name__)
+
+FRAME_MAGIC = b'EL'
+FRAME_VERSION = 2
+# Frame version -> nanoseconds per timestamp unit of its readings
+_FRAME_TIMESTAMP_NS = {1: 1000000000, 2: 1}
+_FRAME_HEADER = struct.Struct('>2sBBQQI')
+LENGTH = struct.Struct('>I')
+ACK = struct.Struct('>BQ')
+
+ACK_OK = 0
+ACK_WRONG_SHARD = 1
+ACK_INVALID = 2
+ACK_BUSY = 3
+
+# MQTT topic for forwarded frames: energylogger/forward/<shard>/<site>
+MQTT_FORWARD_TOPIC = 'energylogger/forward'
+
+# Largest frame accepted over TCP
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    pass
+
+
+def site_shard(site, shard_count):
+    return zlib.crc32(site.encode('utf-8')) % shard_count
+
+
+def encode_frame(site, boot_id, seq, readings):
+    site_bytes = site.encode('utf-8')
+    payload = zlib.compress(json.dumps(readings, separators=(',', ':')).encode('utf-8'))
+    return _FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(site_bytes), boot_id, seq, len(readings)) + \
+        site_bytes + payload
+
+
+def decode_frame(frame):
+    # Returns (site, boot_id, seq, readings)
+    try:
+        magic, version, site_length, boot_id, seq, count = _FRAME_HEADER.unpack_from(frame)
+    except struct.error as err:
+        raise FrameError(f'Truncated frame: {err}')
+    if magic != FRAME_MAGIC or version not in _FRAME_TIMESTAMP_NS:
+        raise FrameError(f'Unknown frame format {magic!r} v{version}')
+
+    offset = _FRAME_HEADER.size
+    try:
+        site = bytes(frame[offset:offset + site_length]).decode('utf-8')
+    except UnicodeDecodeError as err:
+        raise FrameError(f'Invalid site name: {err}')
+    try:
+        readings = json.loads(zlib.decompress(frame[offset + site_length:]))
+    except (zlib.error, ValueError) as err:
+        raise FrameError(f'Invalid frame payload from {site}: {err}')
+    if not isinstance(readings, list) or len(readings) != count:
+        raise FrameError(f'Frame from {site} does not have the expected {count} readings')
+    for reading in readings:
+        if not _valid_reading(reading):
+            raise FrameError(f'Frame from {site} has an invalid reading: {reading!r}')
+    timestamp_ns = _FRAME_TIMESTAMP_NS[version]
+    if timestamp_ns != 1:
+        for reading in readings:
+            reading[4] *= timestamp_ns
+    return site, boot_id, seq, readings
+
+
+def _valid_reading(reading):
+    # [prefix, topic, tag, value, timestamp], see the module docstring
+    if not isinstance(reading, list) or len(reading) != 5:
+        return False
+    prefix, topic, tag, value, timestamp = reading
+    return isinstance(prefix, str) and isinstance(topic, str) and isinstance(tag, str) and \
+        isinstance(value, (str, int, float)) and isinstance(timestamp, int) and not isinstance(timestamp, bool)
+
+
+class _FrameHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        aggregator = self.server.aggregator
+        peer = f'{self.client_address[0]}:{self.client_address[1]}'
+        while True:
+            header = self._recv_exactly(LENGTH.size)
+            if header is None:
+                return
+            length, = LENGTH.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                logger.error(f'Frame of {length} bytes from {peer} is too large, closing connection')
+                return
+            frame = self._recv_exactly(length)
+            if frame is None:
+                return
+
+            status, seq = aggregator.accept(frame, peer)
+            self.request.sendall(ACK.pack(status, seq))
+
+    def _recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class _FrameServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class AggregatorServer(threading.Thread):
+    def __init__(self, listen, url, token, org, bucket_id, shard_index=0, shard_count=1, mqtt_settings=None,
+                 batch_size=5000, flush_interval=1.0, max_buffer=500000, series=None, gzip=False, precision='ns'):
+        super().__init__()
+        host, port = listen.rsplit(':', 1)
+        self.listen = (host, int(port))
+        self.org = org
+        self.bucket_id = bucket_id
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        # (server, port, user, password) to also receive frames over MQTT, or None
+        self.mqtt_settings = mqtt_settings
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.stop_event = threading.Event()
+        # Timestamps are written as integers in this precision, like InfluxLogger
+        self.write_precision, self.precision_ns = lineprotocol.PRECISIONS[precision]
+        # Series registry: the escaped 'measurement,tags field=' prefix per (site, prefix, topic, tag) is cached by
+        # series ID
+        self.series = series or get_registry()
+        self.line_prefixes = [None] * self.series.max_series
+
+        self.client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip)
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+
+        # site -> (boot_id, last sequence number) of the last accepted frame
+        self.sites = {}
+        # Line protocol waiting to be written, oldest first. Lines are only removed once InfluxDB has them. When
+        # max_buffer lines are waiting, new frames are refused (ACK_BUSY, counted) and the edges keep them.
+        self.lines = deque()
+        self.refused = 0
+        self.lock = threading.Lock()
+        self.flush_needed = threading.Event()
+        # Set while disconnected from the MQTT broker because the buffer is full
+        self.mqtt_paused = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush_needed.set()
+
+    def set_rate_overrides(self, rate_overrides):
+        # Rates are applied by the edges
+        pass
+
+    def accept(self, frame, source, defer=True):
+        # Returns (ack status, sequence number). With defer=False (MQTT), the frame is taken even if the buffer is full.
+        try:
+            site, boot_id, seq, readings = decode_frame(frame)
+        except FrameError as err:
+            logger.error(f'Invalid frame from {source}: {err}')
+            return ACK_INVALID, 0
+
+        if site_shard(site, self.shard_count) != self.shard_index:
+            logger.error(f'Site {site} ({source}) belongs to shard {site_shard(site, self.shard_count)}, '
+                         f'this is shard {self.shard_index}')
+            return ACK_WRONG_SHARD, seq
+
+        lines = []
+        for prefix, topic, tag, value, timestamp in readings:
+            line = self._format_line(site, prefix, topic, tag, value, timestamp)
+            if line is not None:
+                lines.append(line)
+
+        with self.lock:
+            # Boot IDs are only compared for equality: they are the edge's wall clock at start, which can go back
+            # after a reboot (no RTC, before NTP sync). A different boot ID starts a new sequence.
+            last_boot_id, last_seq = self.sites.get(site, (0, 0))
+            if boot_id == last_boot_id and seq <= last_seq:
+                # Retransmission of a frame we already have (e.g. the ack was lost): acknowledge, don't write
+                logger.debug('Duplicate frame %s from %s', seq, site)
+                return ACK_OK, seq
+            if defer and self.lines and len(self.lines) + len(lines) > self.max_buffer:
+                # The edge keeps the frame and sends it again later
+                self.refused += 1
+                if self.refused % 100 == 1:
+                    logger.warning(f'Aggregator buffer full ({len(self.lines)} lines), refusing frames '
+                                   f'({self.refused} refused so far)')
+                return ACK_BUSY, seq
+            self.sites[site] = (boot_id, seq)
+            self.lines.extend(lines)
+            if len(self.lines) >= self.batch_size:
+                self.flush_needed.set()
+
+        return ACK_OK, seq
+
+    def forget_line_prefix(self, series_id):
+        self.line_prefixes[series_id] = None
+
+    def _format_line(self, site, prefix, topic, tag, value, timestamp):
+        # 'measurement,location=lt,site=site field=value timestamp', or None if the value cannot be written
+        value = lineprotocol.format_value(value)
+        if value is None:
+            return None
+        series_id = self.series.lookup((site, prefix, topic, tag))
+        if series_id is None:
+            # Series limit reached: not cached
+            line_prefix = lineprotocol.line_prefix(prefix, topic, tag, site)
+        else:
+            line_prefix = self.line_prefixes[series_id]
+            if line_prefix is None:
+                line_prefix = self.line_prefixes[series_id] = lineprotocol.line_prefix(prefix, topic, tag, site)
+        return f'{line_prefix}{value} {timestamp // self.precision_ns}'
+
+    def buffer_full(self):
+        return len(self.lines) >= self.max_buffer
+
+    def write(self, lines):
+        # Returns True when InfluxDB has the lines
+        try:
+            self.write_api.write(bucket=self.bucket_id, org=self.org, record='\n'.join(lines),
+                                 write_precision=self.write_precision)
+        except Exception as err:
+            logger.error(f'Influx exception: {err}')
+            return False
+        logger.debug('Wrote %d lines to InfluxDB', len(lines))
+        return True
+
+    def flush(self):
+        # Write the buffered lines, oldest first and in batches of up to batch_size lines. Returns True when all
+        # lines were written, the unwritten lines stay in the buffer.
+        while True:
+            with self.lock:
+                batch = list(islice(self.lines, self.batch_size))
+            if not batch:
+                return True
+            if not self.write(batch):
+                return False
+            with self.lock:
+                # Only accept() adds lines, at the other end
+                for _ in range(len(batch)):
+                    self.lines.popleft()
+
+    def mqtt_on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(f'{MQTT_FORWARD_TOPIC}/{self.shard_index}/+', qos=1)
+            logger.info(f'Receiving forwarded frames over MQTT (shard {self.shard_index})')
+        else:
+            logger.error(f'Connecting to MQTT server failed with result code {rc}')
+
+    def mqtt_on_message(self, client, userdata, msg):
+        # MQTT cannot refuse a frame: when the buffer is full, disconnect from the broker, which keeps the next frames
+        # (persistent session, QoS 1) until run() reconnects
+        self.accept(msg.payload, msg.topic, defer=False)
+        if self.buffer_full() and not self.mqtt_paused.is_set():
+            logger.warning(f'Aggregator buffer full ({len(self.lines)} lines), pausing MQTT')
+            self.mqtt_paused.set()
+            client.disconnect()
+
+    def run(self):
+        logger.info(f'Starting aggregator on {self.listen[0]}:{self.listen[1]} '
+                    f'(shard {self.shard_index} of {self.shard_count})...')
+        self.series.add_listener(self.forget_line_prefix)
+        server = _FrameServer(self.listen, _FrameHandler)
+        server.aggregator = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        mqtt_client = None
+        if self.mqtt_settings is not None:
+            mqtt_server, mqtt_port, mqtt_user, mqtt_password = self.mqtt_settings
+            mqtt_client = mqtt.Client(f'energylogger_aggregator_{self.shard_index}', clean_session=False)
+            mqtt_client.username_pw_set(mqtt_user, mqtt_password)
+            mqtt_client.on_connect = self.mqtt_on_connect
+            mqtt_client.on_message = self.mqtt_on_message
+            # Connect from paho's network thread, which keeps reconnecting while the broker is unreachable
+            mqtt_client.connect_async(mqtt_server, mqtt_port)
+            mqtt_client.loop_start()
+
+        # Backoff while InfluxDB is unreachable
+        retry_at = 0.0
+        retry_interval = 1
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if now < retry_at:
+                # However many lines arrive meanwhile, wait for the retry
+                self.stop_event.wait(retry_at - now)
+            else:
+                self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+            if self.stop_event.is_set():
+                break
+
+            if self.flush():
+                retry_interval = 1
+            else:
+                retry_at = time.monotonic() + retry_interval
+                retry_interval = min(retry_interval * 2, 60)
+                logger.warning(f'{len(self.lines)} line(s) buffered, retrying in {retry_at - time.monotonic():.0f}s')
+
+            if self.mqtt_paused.is_set() and len(self.lines) <= self.max_buffer // 2:
+                logger.info('Aggregator buffer has room again, resuming MQTT')
+                mqtt_client.loop_stop()
+                mqtt_client.connect_async(mqtt_server, mqtt_port)
+                mqtt_client.loop_start()
+                self.mqtt_paused.clear()
+
+        server.shutdown()
+        server.server_close()
+        if mqtt_client is not None:
+            mqtt_client.loop_stop()
+            mqtt_client.disconnect()
+        if not self.flush():
+            logger.error(f'Aggregator stopped with {len(self.lines)} line(s) not written')
+        self.series.remove_listener(self.forget_line_prefix)
+        self.client.__del__()
+        logger.info('Aggregator stopped')
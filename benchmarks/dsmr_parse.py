@@ -0,0 +1,76 @@
+"""
+Compare the text and byte-level DSMR parsers on a recorded telegram.
+
+Reports time and peak traced memory (tracemalloc) per telegram, and checks that both parsers produce the same
+readings.
+
+Usage: python -m benchmarks.dsmr_parse [telegram file] [iterations]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+from devices.dsmr import byteparser
+from devices.dsmr.smartmeter import DSMRMeter
+
+_DEFAULT_TELEGRAM = os.path.join(os.path.dirname(__file__), 'telegram.txt')
+
+
+class _ListQueue(list):
+    put = list.append
+
+
+def parse_text(meter, raw):
+    # Same steps as DSMRMeter.read_telegram() + run() in text mode
+    meter.queue.clear()
+    telegram = meter.preprocess(raw.decode('ascii'))
+    for item in telegram.splitlines():
+        meter.parse_telegram(item)
+    return meter.queue
+
+
+def parse_bytes(meter, raw):
+    return byteparser.parse_telegram(raw, series=meter.series)
+
+
+def measure(name, parse, meter, raw, iterations):
+    parse(meter, raw)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    parse(meter, raw)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(meter, raw)
+    elapsed = time.perf_counter() - start
+
+    print(f'{name:>5}: {elapsed / iterations * 1e6:8.1f} us/telegram, peak {peak:6d} B/telegram')
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else _DEFAULT_TELEGRAM
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    meter = DSMRMeter(_ListQueue(), None)
+    text_readings = list(parse_text(meter, raw))
+    byte_readings = parse_bytes(meter, bytearray(raw))
+    if text_readings != byte_readings:
+        for text_reading, byte_reading in zip(text_readings, byte_readings):
+            if text_reading != byte_reading:
+                print(f'Mismatch: text {text_reading} != bytes {byte_reading}')
+        sys.exit(f'Parsers disagree ({len(text_readings)} text readings, {len(byte_readings)} byte readings)')
+    print(f'{len(byte_readings)} readings per telegram, both parsers agree')
+
+    measure('text', parse_text, meter, raw, iterations)
+    measure('bytes', parse_bytes, meter, bytearray(raw), iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Read many P1 meters over TCP from a single thread, against local simulators.
+
+Starts one simulator per meter, streaming the recorded telegram, and reports telegrams and readings per second and
+the CPU time used by the reader process.
+
+Usage: python -m benchmarks.p1_network [meters] [seconds] [interval]
+"""
+import os
+import sys
+import time
+import queue
+
+from devices.dsmr.p1network import P1NetworkMeters
+from devices.dsmr.simulator import P1Simulator, load_telegrams
+
+_TELEGRAM = os.path.join(os.path.dirname(__file__), 'telegram.txt')
+
+
+def main():
+    meter_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    interval = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    telegrams = load_telegrams(_TELEGRAM)
+    simulators = [P1Simulator(telegrams, interval=interval) for _ in range(meter_count)]
+    for simulator in simulators:
+        simulator.start()
+
+    readings = queue.Queue()
+    meters = {f'm{index}': ('127.0.0.1', simulator.port) for index, simulator in enumerate(simulators)}
+    reader = P1NetworkMeters(readings, meters)
+
+    cpu_start = time.process_time()
+    reader.start()
+    time.sleep(seconds)
+    reader.stop()
+    reader.join()
+    cpu = time.process_time() - cpu_start
+
+    items = []
+    while not readings.empty():
+        items.append(readings.get())
+    prefixes = {item[0] for item in items}
+    print(f'{meter_count} meters, {seconds:.0f}s: {len(items)} readings from {len(prefixes)} prefixes '
+          f'({len(items) / seconds:.0f} readings/s), {cpu:.2f}s CPU (including the simulators)')
+
+    for simulator in simulators:
+        simulator.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Time a Sun2000 poll cycle over Modbus TCP against the local simulator.
+
+Compares the register getters (one round-trip per register, as over Modbus RTU) with Sun2000.get_metrics(), the
+pipelined poll used over Modbus TCP (one round-trip for all registers). Modbus RTU needs real hardware and is not benchmarked here.
+
+Usage: python -m benchmarks.sun2000_transport [iterations]
+"""
+import sys
+import time
+import queue
+
+from devices.sun2000.simulator import ModbusTCPSimulator
+from devices.sun2000.sun2000 import Sun2000
+
+def poll_getters(inverter):
+    inverter.get_device_status()
+    inverter.get_internal_temp()
+    inverter.get_metrics_registers()
+
+
+def poll_pipelined(inverter):
+    inverter.get_device_status()
+    inverter.get_internal_temp()
+    inverter.get_metrics()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    simulator = ModbusTCPSimulator()
+    simulator.start()
+
+    inverter = Sun2000(queue.Queue(), f'tcp://127.0.0.1:{simulator.port}')
+    inverter.instrument.connect_delay = 0
+    print(f'Model: {inverter.get_model().rstrip(chr(0))}, {inverter.get_pv_strings_number()} PV strings')
+    inverter.pv_string_count = inverter.get_pv_strings_number()
+
+    for name, poll in (('getters', poll_getters), ('pipelined', poll_pipelined)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            poll(inverter)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>9}: {elapsed / iterations * 1e3:7.3f} ms per poll cycle')
+
+    inverter.instrument.close()
+    simulator.shutdown()
+
+
+if __name__ == '__main__':
+    main()
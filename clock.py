@@ -0,0 +1,34 @@
+"""
+Wall clock for reading timestamps.
+
+time.time() follows every step and slew of the system clock, and asking for it (or datetime.utcnow()) per reading
+gives the readings of one telegram slightly different timestamps. Devices take one timestamp per acquisition frame
+(telegram or poll cycle) from time_ns(): the wall clock anchored to the monotonic clock, so timestamps advance
+exactly with the monotonic clock and never jump between resyncs. The anchor is resynchronized with the wall clock
+every RESYNC_INTERVAL seconds, to follow NTP corrections.
+"""
+import time
+
+# Seconds between resyncs of the anchor with the wall clock
+RESYNC_INTERVAL = 600
+
+_RESYNC_INTERVAL_NS = RESYNC_INTERVAL * 1000000000
+
+# (wall clock, monotonic clock) in ns, swapped as a whole so readers in other threads never see half an anchor
+_anchor = (time.time_ns(), time.monotonic_ns())
+
+
+def resync():
+    global _anchor
+    _anchor = (time.time_ns(), time.monotonic_ns())
+
+
+def time_ns():
+    # UNIX epoch in nanoseconds (integer)
+    wall0, mono0 = _anchor
+    elapsed = time.monotonic_ns() - mono0
+    if elapsed >= _RESYNC_INTERVAL_NS:
+        resync()
+        wall0, mono0 = _anchor
+        elapsed = time.monotonic_ns() - mono0
+    return wall0 + elapsed
@@ -0,0 +1,58 @@
+import os
+import threading
+import logging
+import configparser
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Polls the config file for changes. When the file is modified, it is parsed into a fresh ConfigParser and
+    validated as a whole; only a valid config is handed to on_change, so a half-edited file never replaces
+    the running configuration.
+    """
+    def __init__(self, path, validate, on_change, interval=5):
+        super().__init__(daemon=True)
+        self.path = path
+        self.validate = validate
+        self.on_change = on_change
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError as err:
+            logger.warning(f'Unable to stat config file {self.path}: {err}')
+            return None
+
+    def run(self):
+        logger.info(f'Watching {self.path} for changes...')
+        last_mtime = self._mtime()
+
+        while not self.stop_event.wait(self.interval):
+            mtime = self._mtime()
+            if mtime is None or mtime == last_mtime:
+                continue
+            last_mtime = mtime
+
+            new_config = configparser.ConfigParser()
+            try:
+                new_config.read(self.path)
+            except configparser.Error as err:
+                logger.error(f'Unable to parse {self.path}: {err}. Keeping the current configuration.')
+                continue
+
+            if not self.validate(new_config):
+                logger.error(f'{self.path} is invalid. Keeping the current configuration.')
+                continue
+
+            logger.info(f'{self.path} changed, applying new configuration...')
+            try:
+                self.on_change(new_config)
+            except Exception as err:
+                logger.error(f'Error applying new configuration: {err}')
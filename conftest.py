@@ -0,0 +1,2 @@
+# Lets pytest import the top-level modules (clock, series, workers, ...) and the devices package, like
+# energylogger.py does when it is run from this directory
@@ -1,24 +1,48 @@
 import atexit
+import time
+import socket
 import threading
 import logging
-from influxdb_client import InfluxDBClient, Point
+from queue import Empty
+from collections import deque
+from influxdb_client import InfluxDBClient
 from influxdb_client.client.write_api import SYNCHRONOUS
 import paho.mqtt.client as mqtt
-from datetime import datetime
+
+import aggregator
+import lineprotocol
+import tracing
+from series import SeriesRates, SeriesThrottle, get_registry
 
 logger = logging.getLogger(__name__)
 
 
 class InfluxLogger(threading.Thread):
-    def __init__(self, queue, url, token, org, bucket_id):
+    def __init__(self, queue, url, token, org, bucket_id, series=None, gzip=False, precision='ns', batch_size=500,
+                 flush_interval=1.0, max_buffer=10000):
         super().__init__()
         self.queue = queue
+        # Series registry, shared with the devices and the other sinks
+        self.series = series or get_registry()
         self.url = url
         self.token = token
         self.org = org
         self.bucket_id = bucket_id
+        # Timestamps are written as integers in this precision
+        self.write_precision, self.precision_ns = lineprotocol.PRECISIONS[precision]
+        # Lines are written in batches of up to batch_size lines, at most flush_interval seconds after the first one
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Lines kept for a retry while InfluxDB is unreachable. When full, the oldest lines are dropped (and counted).
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self.stop_event = threading.Event()
+        # Per-series message rate overrides ('prefix/topic/tag' -> messages per hour), see set_rate_overrides()
+        self.rate_overrides = {}
+        # Escaped 'measurement,location=lt field=' per series ID, built on first use
+        self.line_prefixes = [None] * self.series.max_series
         self.client = InfluxDBClient(
-            url=self.url, token=self.token, org=self.org)
+            url=self.url, token=self.token, org=self.org, enable_gzip=gzip)
 
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
 
@@ -30,71 +54,158 @@ class InfluxLogger(threading.Thread):
         # print("on_exit called")
         logger.info('Exiting...')
 
-    def write(self, data):
+    def stop(self):
+        self.stop_event.set()
+
+    def set_rate_overrides(self, rate_overrides):
+        # Swap in a new dict instead of mutating the current one, so the run loop never sees a half-updated mapping
+        self.rate_overrides = rate_overrides
+
+    def forget_line_prefix(self, series_id):
+        self.line_prefixes[series_id] = None
+
+    def write(self, lines):
+        # Returns True when InfluxDB has the lines
         try:
-            line_protocol = data.to_line_protocol()
-            logging.debug(data)
-            logging.debug(f'Line: {line_protocol}')
-            self.write_api.write(bucket=self.bucket_id, org=self.org, record=line_protocol)
+            logger.debug('Lines: %s', lines)
+            self.write_api.write(bucket=self.bucket_id, org=self.org, record='\n'.join(lines),
+                                 write_precision=self.write_precision)
         except Exception as err:
             logger.error(f'Influx exception: {err}')
+            return False
+        return True
 
-    def _format_line(self, prefix, topic, key, value):
-        p = Point(f'{prefix}_{topic}').tag('location', 'lt').time(time=datetime.utcnow()).field(key, value)
+    def flush(self, lines, traces):
+        # Write the lines, oldest first and in batches of up to batch_size lines. Returns True when all lines were
+        # written, the unwritten lines are left in lines.
+        while lines:
+            if not self.write(lines[:self.batch_size]):
+                return False
+            del lines[:self.batch_size]
+        for trace in traces:
+            tracing.written(trace, 'influx')
+        traces.clear()
+        return True
 
-        return p
+    def _format_line(self, series_id, item):
+        # 'measurement,location=lt field=value timestamp', or None if the value cannot be written
+        value = lineprotocol.format_value(item[3])
+        if value is None:
+            return None
+        line_prefix = self.line_prefixes[series_id]
+        if line_prefix is None:
+            line_prefix = self.line_prefixes[series_id] = lineprotocol.line_prefix(item[0], item[1], item[2])
+        return f'{line_prefix}{value} {item[5] // self.precision_ns}'
 
     def run(self):
         logger.info('Starting InfluxDB Logger...')
-        # Received format: [prefix, topic, key, value, messagerate] (list)
+        # Received format: [prefix, topic, key, value, messagerate, timestamp, series ID] (list)
 
-        # Set up a dict to hold temporary data (for timestamp purposes)
-        last_msg = {}
+        # Per-series throttle state and message rates, indexed by series ID
+        throttle = SeriesThrottle(self.series)
+        last_ts = throttle.last_ts
+        rates = SeriesRates(self.series, self.rate_overrides)
+        rate_by_id = rates.rates
+        self.series.add_listener(self.forget_line_prefix)
 
-        while True:
-            item = self.queue.get()
-            logger.debug(f'InfluxDB Logger received item: {item}')
+        # Lines (and traces of the traced readings) waiting to be written
+        lines = []
+        traces = []
+        flush_at = 0.0
+        # Backoff while InfluxDB is unreachable
+        retry_at = 0.0
+        retry_interval = 1
 
-            # Calculate message rate
-            if int(item[4]) == 0:
-                min_time_interval = -1
-            else:
-                min_time_interval = int(3600/int(item[4]))
+        while not self.stop_event.is_set():
+            try:
+                item = self.queue.get(timeout=max(0.0, max(flush_at, retry_at) - time.monotonic()) if lines else 1)
+            except Empty:
+                item = None
 
-            # Set the current timestamp (UNIX epoch as integer)
-            current_ts = int((datetime.now() - datetime(1970, 1, 1)).total_seconds())
-            prefix = item[0]
-            topic = item[1]
-            tag = item[2]
-            value = item[3]
+            if item is not None:
+                trace = tracing.dequeued(item)
+                logger.debug('InfluxDB Logger received item: %s', item)
+
+                # Message rate (a configured override takes precedence over the device definition), resolved once
+                # per series ID
+                if rates.overrides is not self.rate_overrides:
+                    rates.set_overrides(self.rate_overrides)
+                series_id = item[6]
+                if series_id is not None:
+                    message_rate = rate_by_id[series_id]
+                    if message_rate < 0:
+                        message_rate = rate_by_id[series_id] = rates.resolve(item)
+                else:
+                    # Not interned by the device (rate 0 definition): looked up if an override enables it (None if
+                    # the series limit is reached)
+                    message_rate = rates.resolve(item)
+                    if message_rate != 0:
+                        series_id = self.series.lookup((item[0], item[1], item[2]))
 
-            if min_time_interval != -1:
-                # If the message rate is not 0 (-1, as calculated above), update the temporary message dict
-                if prefix not in last_msg:
-                    last_msg[prefix] = {}
-                    last_msg[prefix]['value'] = value
-                    last_msg[prefix]['timestamp'] = current_ts
-                    # Post to InfluxDB
-                    self.write(self._format_line(prefix, topic, tag, value))
+                if series_id is not None and message_rate != 0:
+                    # Throttle on the reading's timestamp (UNIX epoch, seconds)
+                    current_ts = item[5] // 1000000000
+                    last = last_ts[series_id]
+                    if not last or current_ts >= last + int(3600/message_rate):
+                        last_ts[series_id] = current_ts
+                        tracing.throttled(trace)
+                        line = self._format_line(series_id, item)
+                        if line is not None:
+                            if not lines:
+                                flush_at = time.monotonic() + self.flush_interval
+                            lines.append(line)
+                            if trace is not None:
+                                traces.append(trace)
 
+            # Post to InfluxDB
+            now = time.monotonic()
+            if lines and now >= retry_at and (len(lines) >= self.batch_size or now >= flush_at):
+                if self.flush(lines, traces):
+                    retry_interval = 1
                 else:
-                    prev_ts = last_msg[prefix]['timestamp']
-                    if current_ts >= prev_ts + min_time_interval:
-                        last_msg[prefix]['value'] = value
-                        last_msg[prefix]['timestamp'] = current_ts
-                        # Post to InfluxDB
-                        self.write(self._format_line(prefix, topic, tag, value))
+                    retry_at = now + retry_interval
+                    retry_interval = min(retry_interval * 2, 60)
+                    if len(lines) > self.max_buffer:
+                        dropped = len(lines) - self.max_buffer
+                        del lines[:dropped]
+                        del traces[:max(0, len(traces) - self.max_buffer)]
+                        self.dropped += dropped
+                        logger.warning(f'InfluxDB buffer full ({self.max_buffer} lines), dropped the oldest '
+                                       f'{dropped} line(s), {self.dropped} dropped so far')
+                    logger.warning(f'{len(lines)} line(s) kept, retrying in {retry_at - now:.0f}s')
+
+        if lines and not self.flush(lines, traces):
+            logger.error(f'InfluxDB Logger stopped with {len(lines)} line(s) not written')
+        throttle.close()
+        rates.close()
+        self.series.remove_listener(self.forget_line_prefix)
+        self.on_exit(self.client, self.write_api)
+        atexit.unregister(self.on_exit)
 
 
 class MQTTLogger(threading.Thread):
-    def __init__(self, queue, mqtt_server, mqtt_port, mqtt_user, mqtt_password, mqtt_client_id):
+    def __init__(self, queue, mqtt_server, mqtt_port, mqtt_user, mqtt_password, mqtt_client_id, series=None):
         super().__init__()
         self.queue = queue
+        # Series registry, shared with the devices and the other sinks
+        self.series = series or get_registry()
+        # MQTT topic per series ID, built on first use
+        self.topics = [None] * self.series.max_series
         self.mqtt_server = mqtt_server
         self.mqtt_port = mqtt_port
         self.mqtt_user = mqtt_user
         self.mqtt_password = mqtt_password
         self.mqtt_client_id = mqtt_client_id
+        self.stop_event = threading.Event()
+        # Per-series message rate overrides ('prefix/topic/tag' -> messages per hour), see set_rate_overrides()
+        self.rate_overrides = {}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def set_rate_overrides(self, rate_overrides):
+        # Swap in a new dict instead of mutating the current one, so the run loop never sees a half-updated mapping
+        self.rate_overrides = rate_overrides
 
     # MQTT callbacks
     def mqtt_on_connect(self, client, userdata, flags, rc):
@@ -105,20 +216,27 @@ class MQTTLogger(threading.Thread):
         logger.info(f'Connecting to MQTT server... Result: {resultstr}')
         # client.subscribe("$SYS/#")
 
+    def forget_topic(self, series_id):
+        self.topics[series_id] = None
+
     def mqtt_publish(self, client, topic, msg):
         result = client.publish(topic, msg)
         status = result[0]
         if status == 0:
-            logger.debug(f'MQTT: Published value ({msg}) to {topic}!')
+            logger.debug('MQTT: Published value (%s) to %s!', msg, topic)
         else:
             logger.warning(f'Unable to publish to MQTT topic {topic}! Message: {msg}')
 
     def run(self):
         logger.info('Starting MQTT Logger...')
-        # Received format: [prefix, topic, tag, value, messagerate] (list)
+        # Received format: [prefix, topic, tag, value, messagerate, timestamp, series ID] (list)
 
-        # Set up a dict to hold temporary data (for timestamp purposes)
-        last_msg = {}
+        # Per-series throttle state and message rates, indexed by series ID
+        throttle = SeriesThrottle(self.series)
+        last_ts = throttle.last_ts
+        rates = SeriesRates(self.series, self.rate_overrides)
+        rate_by_id = rates.rates
+        self.series.add_listener(self.forget_topic)
 
         # MQTT client
         mqtt_client = mqtt.Client(self.mqtt_client_id)
@@ -128,35 +246,240 @@ class MQTTLogger(threading.Thread):
 
         mqtt_client.loop_start()
 
-        while True:
-            item = self.queue.get()
-            logger.debug(f'MQTT Logger received item: {item}')
+        while not self.stop_event.is_set():
+            try:
+                item = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            trace = tracing.dequeued(item)
+            logger.debug('MQTT Logger received item: %s', item)
 
-            # Calculate message rate
-            if int(item[4]) == 0:
-                min_time_interval = -1
+            # Message rate (a configured override takes precedence over the device definition), resolved once per
+            # series ID
+            if rates.overrides is not self.rate_overrides:
+                rates.set_overrides(self.rate_overrides)
+            series_id = item[6]
+            if series_id is not None:
+                message_rate = rate_by_id[series_id]
+                if message_rate < 0:
+                    message_rate = rate_by_id[series_id] = rates.resolve(item)
             else:
-                min_time_interval = int(3600/int(item[4]))
-
-            # Set the current timestamp (UNIX epoch as integer)
-            current_ts = int((datetime.now() - datetime(1970, 1, 1)).total_seconds())
-            topic = f'{item[0]}/{item[1]}/{item[2]}'
+                # Not interned by the device (rate 0 definition): looked up if an override enables it
+                message_rate = rates.resolve(item)
+                if message_rate != 0:
+                    series_id = self.series.lookup((item[0], item[1], item[2]))
+                    if series_id is None:
+                        # Series limit reached
+                        continue
+            if message_rate == 0:
+                # Message rate 0: never published
+                continue
+            min_time_interval = int(3600/message_rate)
+            topic = self.topics[series_id]
+            if topic is None:
+                topic = self.topics[series_id] = f'{item[0]}/{item[1]}/{item[2]}'
             value = item[3]
 
-            if min_time_interval != -1:
-                # If the message rate is not 0 (-1, as calculated above), update the temporary message dict
-                if topic not in last_msg:
-                    last_msg[topic] = {}
-                    last_msg[topic]['value'] = value
-                    last_msg[topic]['timestamp'] = current_ts
-                    # Post to MQTT
-                    logger.debug(f'MQTT Publish: {topic}, {value}')
-                    self.mqtt_publish(mqtt_client, topic, value)
+            # Throttle on the reading's timestamp (UNIX epoch, seconds)
+            current_ts = item[5] // 1000000000
+            last = last_ts[series_id]
+            if not last or current_ts >= last + min_time_interval:
+                last_ts[series_id] = current_ts
+                # Post to MQTT
+                logger.debug('MQTT Publish: %s, %s', topic, value)
+                tracing.throttled(trace)
+                self.mqtt_publish(mqtt_client, topic, value)
+                tracing.written(trace, 'mqtt')
+
+        throttle.close()
+        rates.close()
+        self.series.remove_listener(self.forget_topic)
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
+        logger.info('MQTT Logger stopped')
+
+
+class ForwardLogger(threading.Thread):
+    def __init__(self, queue, site, centrals=None, mqtt_settings=None, shard_count=1,
+                 batch_size=500, batch_interval=10, buffer_frames=1000, series=None):
+        super().__init__()
+        self.queue = queue
+        # Series registry, shared with the devices and the other sinks
+        self.series = series or get_registry()
+        self.site = site
+        # TCP: list of (host, port) of the central instances, the site's shard picks one. MQTT: (server, port,
+        # user, password) of the broker, shard_count is the number of central instances.
+        self.centrals = centrals
+        self.mqtt_settings = mqtt_settings
+        self.shard_count = len(centrals) if centrals else shard_count
+        self.shard = aggregator.site_shard(site, self.shard_count)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        # Frames waiting to be acknowledged by the central instance. When full, the oldest frame is dropped.
+        self.pending = deque()
+        self.buffer_frames = buffer_frames
+        self.stop_event = threading.Event()
+        # Per-series message rate overrides ('prefix/topic/tag' -> messages per hour), see set_rate_overrides()
+        self.rate_overrides = {}
+        self.sock = None
+        self.mqtt_client = None
+
+    def stop(self):
+        self.stop_event.set()
+
+    def set_rate_overrides(self, rate_overrides):
+        # Swap in a new dict instead of mutating the current one, so the run loop never sees a half-updated mapping
+        self.rate_overrides = rate_overrides
+
+    def _send_tcp(self, seq, frame):
+        # Returns True when the central instance has the frame (or rejected it as invalid)
+        if self.sock is None:
+            host, port = self.centrals[self.shard]
+            self.sock = socket.create_connection((host, port), timeout=10)
+            logger.info(f'Forwarding to central instance {host}:{port} (shard {self.shard})')
+
+        self.sock.sendall(aggregator.LENGTH.pack(len(frame)) + frame)
+        ack = bytearray()
+        while len(ack) < aggregator.ACK.size:
+            chunk = self.sock.recv(aggregator.ACK.size - len(ack))
+            if not chunk:
+                raise ConnectionError('Connection closed by central instance')
+            ack += chunk
+
+        status, ack_seq = aggregator.ACK.unpack(ack)
+        if status == aggregator.ACK_OK and ack_seq == seq:
+            return True
+        if status == aggregator.ACK_INVALID:
+            # Retrying will not help
+            logger.error(f'Central instance rejected frame {seq} as invalid, dropping it')
+            return True
+        if status == aggregator.ACK_BUSY:
+            # The central instance cannot write to InfluxDB right now: keep the frame and retry later
+            logger.warning(f'Central instance is busy, keeping frame {seq}')
+            return False
+        raise ConnectionError(f'Central instance refused frame {seq} (status {status})')
+
+    def _send_mqtt(self, seq, frame):
+        if self.mqtt_client is None:
+            mqtt_server, mqtt_port, mqtt_user, mqtt_password = self.mqtt_settings
+            client = mqtt.Client(f'energylogger_{self.site}')
+            client.username_pw_set(mqtt_user, mqtt_password)
+            # Connect from paho's network thread, which keeps reconnecting while the broker is unreachable
+            client.connect_async(mqtt_server, mqtt_port)
+            client.loop_start()
+            self.mqtt_client = client
+
+        if not self.mqtt_client.is_connected():
+            raise ConnectionError('Not connected to the MQTT broker')
+        info = self.mqtt_client.publish(f'{aggregator.MQTT_FORWARD_TOPIC}/{self.shard}/{self.site}', frame, qos=1)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f'Publish failed: {mqtt.error_string(info.rc)}')
+        info.wait_for_publish(timeout=10)
+        return info.is_published()
+
+    def _close_mqtt(self):
+        if self.mqtt_client is not None:
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.disconnect()
+            self.mqtt_client = None
+
+    def _send_pending(self):
+        # Send the buffered frames in order, stop at the first failure and keep the rest for the next attempt
+        while self.pending:
+            seq, frame = self.pending[0]
+            try:
+                if self.centrals:
+                    sent = self._send_tcp(seq, frame)
                 else:
-                    prev_ts = last_msg[topic]['timestamp']
-                    if current_ts >= prev_ts + min_time_interval:
-                        last_msg[topic]['value'] = value
-                        last_msg[topic]['timestamp'] = current_ts
-                        # Post to MQTT
-                        logger.debug(f'MQTT Publish: {topic}, {value}')
-                        self.mqtt_publish(mqtt_client, topic, value)
+                    sent = self._send_mqtt(seq, frame)
+            except (OSError, ValueError, RuntimeError) as err:
+                logger.warning(f'Unable to forward frame {seq}: {err}. {len(self.pending)} frame(s) buffered.')
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                if isinstance(err, RuntimeError):
+                    # Publish failed on a client that lost its connection: start over with a new client
+                    self._close_mqtt()
+                return False
+            if not sent:
+                logger.warning(f'Frame {seq} not acknowledged. {len(self.pending)} frame(s) buffered.')
+                return False
+            self.pending.popleft()
+        return True
+
+    def run(self):
+        logger.info(f'Starting forwarder for site {self.site}...')
+        # Received format: [prefix, topic, tag, value, messagerate, timestamp, series ID] (list)
+
+        # Per-series throttle state and message rates, indexed by series ID
+        throttle = SeriesThrottle(self.series)
+        last_ts = throttle.last_ts
+        rates = SeriesRates(self.series, self.rate_overrides)
+        rate_by_id = rates.rates
+        batch = []
+        # A new boot ID lets the central instance tell a restarted edge (sequence numbers start over) from a
+        # retransmission
+        boot_id = time.time_ns()
+        seq = 0
+        last_flush = time.monotonic()
+        retry_at = 0.0
+        retry_interval = 1
+
+        while not self.stop_event.is_set():
+            try:
+                item = self.queue.get(timeout=1)
+            except Empty:
+                item = None
+
+            if item is not None:
+                trace = tracing.dequeued(item)
+
+                # Message rate (a configured override takes precedence over the device definition), resolved once
+                # per series ID
+                if rates.overrides is not self.rate_overrides:
+                    rates.set_overrides(self.rate_overrides)
+                series_id = item[6]
+                if series_id is not None:
+                    message_rate = rate_by_id[series_id]
+                    if message_rate < 0:
+                        message_rate = rate_by_id[series_id] = rates.resolve(item)
+                else:
+                    # Not interned by the device (rate 0 definition): looked up if an override enables it (None if
+                    # the series limit is reached)
+                    message_rate = rates.resolve(item)
+                    if message_rate != 0:
+                        series_id = self.series.lookup((item[0], item[1], item[2]))
+
+                if series_id is not None and message_rate != 0:
+                    # Throttle on the reading's timestamp (UNIX epoch, seconds)
+                    current_ts = item[5] // 1000000000
+                    last = last_ts[series_id]
+                    if not last or current_ts >= last + int(3600/message_rate):
+                        last_ts[series_id] = current_ts
+                        tracing.throttled(trace)
+                        batch.append([item[0], item[1], item[2], item[3], item[5]])
+                        tracing.written(trace, 'forward')
+
+            now = time.monotonic()
+            if batch and (len(batch) >= self.batch_size or now - last_flush >= self.batch_interval):
+                seq += 1
+                if len(self.pending) >= self.buffer_frames:
+                    dropped_seq, dropped_frame = self.pending.popleft()
+                    logger.warning(f'Forward buffer full, dropping frame {dropped_seq}')
+                self.pending.append((seq, aggregator.encode_frame(self.site, boot_id, seq, batch)))
+                batch = []
+                last_flush = now
+
+            if self.pending and now >= retry_at:
+                if self._send_pending():
+                    retry_interval = 1
+                else:
+                    retry_at = now + retry_interval
+                    retry_interval = min(retry_interval * 2, 60)
+
+        throttle.close()
+        rates.close()
+        if self.sock is not None:
+            self.sock.close()
+        self._close_mqtt()
+        logger.info(f'Forwarder for site {self.site} stopped ({len(self.pending)} frame(s) not forwarded)')
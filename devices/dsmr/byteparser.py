@@ -0,0 +1,161 @@
+"""
+Byte-level DSMR telegram parser.
+
+Works directly on the received telegram bytes: lines, OBIS codes and value spans are located by offset, and only
+the value span itself is converted to a Python float, int or str. There is no ascii decoding of the whole telegram,
+no per-line splitting/replacing and no regex matching, which keeps allocations (and GC pressure) per telegram low.
+
+Produces the same readings as DSMRMeter.parse_telegram() in text mode, including the virtual 1-0:1.8.3 and
+1-0:2.8.3 totals added by DSMRMeter.preprocess().
+"""
+import re
+import logging
+
+from . import datadefinitions as dd
+
+# Matches the value regexes used in the data definitions, e.g. '^.*\((.*)\*kW\)' or '^.*\(\d{26}(.*)\)'
+_DEFINITION_REGEX = re.compile(r'^\^\.\*\\\((?:\\d\{(\d+)\})?\(\.\*\)(.*)\\\)$')
+
+_CONVERTERS = {
+    'float': float,
+    'int': int,
+}
+
+# Tariff registers that are summed into the virtual totals
+_CONSUMED_CODES = (b'1-0:1.8.1', b'1-0:1.8.2')
+_RETURNED_CODES = (b'1-0:2.8.1', b'1-0:2.8.2')
+_CONSUMED_TOTAL_CODE = '1-0:1.8.3'
+_RETURNED_TOTAL_CODE = '1-0:2.8.3'
+
+
+def _compile(definition, index):
+    # Precompute everything parse_telegram needs per OBIS code:
+    # (definition, skip, suffix, converter, multiplication, validate, series slot)
+    # The series slot indexes the SeriesCache of the meter. Rate 0 definitions are not interned (slot None).
+    match = _DEFINITION_REGEX.match(definition[dd.REGEX])
+    if match is None:
+        skip, suffix = 0, None
+    else:
+        skip = int(match.group(1) or 0)
+        suffix = match.group(2).replace('\\', '').encode('ascii')
+
+    d_type = definition[dd.DATATYPE]
+    converter = _CONVERTERS.get(d_type)
+    multiplication = converter(definition[dd.MULTIPLICATION]) if converter else None
+    slot = index if int(definition[dd.MESSAGERATE]) != 0 else None
+    return definition, skip, suffix, converter, multiplication, definition[dd.DATAVALIDATION] == '1', slot
+
+
+_COMPILED = {code.encode('ascii'): _compile(definition, index)
+             for index, (code, definition) in enumerate(dd.DEFINITIONS.items())}
+_CHECKSUM = _COMPILED[b'999-999:0.0']
+_PROVIDER = _COMPILED[b'999-999:0.1']
+_UNKNOWN = _compile(dd.UNKNOWN_DEFINITION, len(dd.DEFINITIONS))
+
+# Size of the SeriesCache of a meter parsed by parse_telegram
+SERIES_SLOTS = len(dd.DEFINITIONS) + 1
+
+
+def _value(buf, start, end, compiled):
+    # Convert the value span of buf[start:end] (line without OBIS code) according to the compiled definition,
+    # without multiplication. A value that does not match the definition is empty, like the regex in text mode.
+    definition, skip, suffix, converter, multiplication, validate, slot = compiled
+    value_start = value_end = start
+    if suffix is not None:
+        # '^.*\(' is greedy: the value starts after the last '(' of the line, and must end with '<suffix>)'
+        open_pos = buf.rfind(b'(', start, end)
+        if open_pos != -1 and buf[end - 1] == 0x29:  # ')'
+            value_start = open_pos + 1 + skip
+            value_end = end - 1 - len(suffix)
+            if value_end < value_start or (suffix and not buf.startswith(suffix, value_end, end - 1)):
+                value_end = value_start
+
+    if converter is None:
+        return buf[value_start:value_end].decode('ascii', 'replace')
+    # Raises ValueError for an empty or malformed value
+    return converter(buf[value_start:value_end])
+
+
+def _reading(prefix, compiled, value, timestamp, series):
+    # Format: [prefix, topic, tag, value, messagerate, timestamp, series ID] (list), or None if the value is invalid
+    definition, skip, suffix, converter, multiplication, validate, slot = compiled
+    if validate and (value is None or value == '' or value == 0):
+        logging.warning(f'Warning: Telegram {definition[dd.DESCRIPTION]} has invalid value ({value}). Skipping...')
+        return None
+    series_id = None
+    if series is not None and slot is not None:
+        series_id = series.slots[slot]
+        if series_id is None:
+            series_id = series.slot(slot, (prefix, definition[dd.MQTT_TOPIC], definition[dd.MQTT_TAG]))
+    return [prefix, definition[dd.MQTT_TOPIC], definition[dd.MQTT_TAG], value, definition[dd.MESSAGERATE], timestamp,
+            series_id]
+
+
+def parse_telegram(buf, prefix='dsmr', timestamp=0, series=None):
+    """
+    Parse a complete telegram (bytes, bytearray or memoryview, from '/' up to and including the '!' checksum line)
+    into a list of readings. All readings get the telegram's timestamp (UNIX epoch in ns, see clock.time_ns()), and
+    their series ID from series (a SeriesCache with SERIES_SLOTS slots, for this prefix) if given.
+    """
+    readings = []
+    consumed = 0.0
+    returned = 0.0
+
+    # OBIS code lookups need hashable slices: take one immutable copy of the telegram instead of one per line
+    if not isinstance(buf, bytes):
+        buf = bytes(buf)
+    pos = 0
+    length = len(buf)
+    while pos < length:
+        end = buf.find(b'\n', pos)
+        if end == -1:
+            end = length
+        next_pos = end + 1
+        if end > pos and buf[end - 1] == 0x0d:  # '\r'
+            end -= 1
+        if end == pos:
+            pos = next_pos
+            continue
+
+        first = buf[pos]
+        if first == 0x21:  # '!'
+            compiled = _CHECKSUM
+            value = _value(buf, pos + 1, end, compiled)
+        elif first == 0x2f:  # '/'
+            compiled = _PROVIDER
+            value = _value(buf, pos, end, compiled)
+        else:
+            paren = buf.find(b'(', pos, end)
+            if paren == -1:
+                paren = end
+            code = buf[pos:paren]
+            compiled = _COMPILED.get(code, _UNKNOWN)
+            try:
+                value = _value(buf, paren, end, compiled)
+            except ValueError:
+                logging.warning(f'Warning: Unable to convert DSMR value for {code}. Skipping...')
+                pos = next_pos
+                continue
+
+            if compiled[3] is not None:
+                # Keep the raw tariff registers (in kWh) for the virtual totals
+                if code in _CONSUMED_CODES:
+                    consumed += value
+                elif code in _RETURNED_CODES:
+                    returned += value
+                value = value * compiled[4]
+
+        reading = _reading(prefix, compiled, value, timestamp, series)
+        if reading is not None:
+            readings.append(reading)
+        pos = next_pos
+
+    # Virtual totals, rounded like the '{:010.3f}' formatting in DSMRMeter.preprocess()
+    for code, total in ((_CONSUMED_TOTAL_CODE, consumed), (_RETURNED_TOTAL_CODE, returned)):
+        compiled = _COMPILED[code.encode('ascii')]
+        reading = _reading(prefix, compiled, compiled[3](round(total, 3)) * compiled[4], timestamp,
+                           series)
+        if reading is not None:
+            readings.append(reading)
+
+    return readings
@@ -0,0 +1,301 @@
+"""
+P1 smart meters over TCP (network P1 dongles, ser2net, ...).
+
+A single thread multiplexes any number of meters with non-blocking sockets and a selector. Complete telegrams are
+cut from each connection's receive buffer and parsed with the byte-level parser. Every meter gets its own prefix
+('dsmr_<name>'), so the readings of different meters end up in separate topics/measurements.
+
+Configured as 'name=host:port, name=host:port, ...', e.g. 'apt1=10.0.0.11:2001, apt2=[fd00::12]:2001'. Host names
+are resolved by a helper thread, so a slow DNS server never stalls the other meters. Meters can be added or removed
+while running (set_meters()), without dropping the connections of the other meters.
+"""
+import time
+import errno
+import socket
+import logging
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import byteparser
+import clock
+import tracing
+from series import SeriesCache
+
+# Drop the receive buffer when it grows beyond this without a complete telegram (garbage on the line)
+_MAX_BUFFER = 16384
+_RECV_SIZE = 4096
+
+
+def parse_meters(value):
+    # 'apt1=10.0.0.11:2001, apt2=[fd00::12]:2001' -> {'apt1': ('10.0.0.11', 2001), 'apt2': ('fd00::12', 2001)}
+    meters = {}
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, address = entry.split('=', 1)
+        host, port = address.strip().rsplit(':', 1)
+        if host.startswith('[') and host.endswith(']'):
+            host = host[1:-1]
+        meters[name.strip()] = (host, int(port))
+    return meters
+
+
+def meter_prefix(name):
+    return f'dsmr_{name}'
+
+
+class _P1Connection:
+    def __init__(self, name, host, port):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.prefix = meter_prefix(name)
+        # Series IDs of the meter's readings, interned once per series
+        self.series = SeriesCache(slots=byteparser.SERIES_SLOTS)
+        self.sock = None
+        self.connected = False
+        self.buffer = bytearray()
+        self.reconnect_at = 0.0
+        # Pending host name resolution (Future), and the resolved addresses not tried yet
+        self.resolving = None
+        self.addresses = []
+
+    def extract_telegrams(self):
+        # Cut complete telegrams ('/' up to and including the '!' checksum line) from the buffer
+        telegrams = []
+        while True:
+            start = self.buffer.find(b'/')
+            if start == -1:
+                self.buffer.clear()
+                break
+            end = self.buffer.find(b'!', start)
+            if end == -1:
+                break
+            end = self.buffer.find(b'\n', end)
+            if end == -1:
+                break
+            telegrams.append(bytes(self.buffer[start:end + 1]))
+            del self.buffer[:end + 1]
+
+        if len(self.buffer) > _MAX_BUFFER:
+            logging.warning(f'P1 meter {self.name}: no telegram in {len(self.buffer)} bytes, discarding buffer')
+            self.buffer.clear()
+        return telegrams
+
+
+class P1NetworkMeters(threading.Thread):
+    def __init__(self, queue, meters, reconnect_interval=10):
+        super().__init__()
+        self.queue = queue
+        self.meters = parse_meters(meters) if isinstance(meters, str) else meters
+        # Kept for the log messages, like serial_port of the other devices
+        self.serial_port = self._describe(self.meters)
+        self.reconnect_interval = reconnect_interval
+        self.stop_event = threading.Event()
+        self.selector = selectors.DefaultSelector()
+        self.connections = [_P1Connection(name, host, port) for name, (host, port) in self.meters.items()]
+        # getaddrinfo() blocks, host names are resolved off the event loop
+        self.resolver = ThreadPoolExecutor(max_workers=1, thread_name_prefix='p1-resolver')
+        # New meters from set_meters(), applied by the event loop
+        self.lock = threading.Lock()
+        self.pending_meters = None
+        # Written to by other threads to wake up the event loop (stop, set_meters, resolved host names)
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+
+    @staticmethod
+    def _describe(meters):
+        return ', '.join(f'{name}@{host}:{port}' for name, (host, port) in meters.items())
+
+    def stop(self):
+        self.stop_event.set()
+        self._wakeup()
+
+    def set_meters(self, meters):
+        # Replace the meter list of the running thread: only the added, removed or changed meters are (dis)connected
+        with self.lock:
+            self.pending_meters = parse_meters(meters) if isinstance(meters, str) else meters
+        self._wakeup()
+
+    def _wakeup(self, *args):
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            # Buffer full (the loop is already being woken up) or closed (the thread has stopped)
+            pass
+
+    def _apply_meters(self):
+        with self.lock:
+            meters, self.pending_meters = self.pending_meters, None
+        if meters is None:
+            return
+
+        connections = []
+        for conn in self.connections:
+            if meters.get(conn.name) == (conn.host, conn.port):
+                connections.append(conn)
+                continue
+            logging.info(f'P1 meter {conn.name} ({conn.host}:{conn.port}) removed or changed, disconnecting')
+            self._close(conn)
+            conn.series.release()
+        current = {conn.name for conn in connections}
+        for name, (host, port) in meters.items():
+            if name not in current:
+                logging.info(f'P1 meter {name} ({host}:{port}) added')
+                connections.append(_P1Connection(name, host, port))
+        self.connections = connections
+        self.meters = meters
+        self.serial_port = self._describe(meters)
+
+    def _connect(self, conn):
+        # Numeric addresses are resolved right away, host names by the resolver thread (wakes up the loop when done)
+        if conn.resolving is None:
+            try:
+                conn.addresses = socket.getaddrinfo(conn.host, conn.port, type=socket.SOCK_STREAM,
+                                                    flags=socket.AI_NUMERICHOST)
+            except socket.gaierror:
+                conn.resolving = self.resolver.submit(socket.getaddrinfo, conn.host, conn.port,
+                                                      type=socket.SOCK_STREAM)
+                conn.resolving.add_done_callback(self._wakeup)
+                return
+        else:
+            resolving, conn.resolving = conn.resolving, None
+            try:
+                conn.addresses = resolving.result()
+            except OSError as err:
+                self._disconnect(conn, f'cannot resolve {conn.host}: {err}')
+                return
+        self._open(conn)
+
+    def _open(self, conn):
+        # Connect to the next resolved address (IPv4 or IPv6)
+        family, sock_type, proto, _, sockaddr = conn.addresses.pop(0)
+        conn.connected = False
+        conn.buffer.clear()
+        try:
+            # Fails e.g. with EAFNOSUPPORT for an IPv6 address on a host without IPv6
+            conn.sock = socket.socket(family, sock_type, proto)
+            conn.sock.setblocking(False)
+            result = conn.sock.connect_ex(sockaddr)
+        except OSError as err:
+            self._connect_failed(conn, f'connect failed: {err}')
+            return
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._connect_failed(conn, f'connect failed: {errno.errorcode.get(result, result)}')
+            return
+        # Writable once the (non-blocking) connect has completed
+        self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+
+    def _connect_failed(self, conn, reason):
+        # Try the next address of the host (e.g. IPv4 after IPv6), reconnect later when none are left
+        if conn.addresses:
+            self._close(conn)
+            self._open(conn)
+        else:
+            self._disconnect(conn, reason)
+
+    def _close(self, conn):
+        if conn.resolving is not None:
+            conn.resolving.cancel()
+            conn.resolving = None
+        if conn.sock is not None:
+            try:
+                self.selector.unregister(conn.sock)
+            except (KeyError, ValueError):
+                pass
+            conn.sock.close()
+            conn.sock = None
+        conn.connected = False
+
+    def _disconnect(self, conn, reason):
+        logging.warning(f'P1 meter {conn.name} ({conn.host}:{conn.port}): {reason}, '
+                        f'reconnecting in {self.reconnect_interval}s')
+        self._close(conn)
+        conn.addresses = []
+        conn.reconnect_at = time.monotonic() + self.reconnect_interval
+
+    def _on_writable(self, conn):
+        error = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._connect_failed(conn, f'connect failed: {errno.errorcode.get(error, error)}')
+            return
+        conn.connected = True
+        conn.addresses = []
+        self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+        logging.info(f'P1 meter {conn.name} connected ({conn.host}:{conn.port})')
+
+    def _on_readable(self, conn):
+        try:
+            chunk = conn.sock.recv(_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            self._disconnect(conn, f'receive failed: {err}')
+            return
+        if not chunk:
+            self._disconnect(conn, 'connection closed')
+            return
+
+        conn.buffer += chunk
+        for telegram in conn.extract_telegrams():
+            timestamp = clock.time_ns()
+            acquired_at = tracing.acquired()
+            for reading in byteparser.parse_telegram(telegram, conn.prefix, timestamp, conn.series):
+                self.queue.put(tracing.traced(reading, acquired_at))
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(_RECV_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run(self):
+        logging.info(f'Starting P1 network meters ({self.serial_port})')
+        for conn in self.connections:
+            self._connect(conn)
+
+        while not self.stop_event.is_set():
+            # Wake up for the next pending reconnect, but at least every second
+            now = time.monotonic()
+            timeout = 1.0
+            for conn in self.connections:
+                if conn.sock is None and conn.resolving is None:
+                    timeout = min(timeout, max(0.0, conn.reconnect_at - now))
+
+            for key, mask in self.selector.select(timeout):
+                conn = key.data
+                if conn is None:
+                    self._drain_wakeup()
+                elif conn.sock is None:
+                    # Disconnected while handling an earlier event of this round
+                    continue
+                elif not conn.connected:
+                    self._on_writable(conn)
+                else:
+                    self._on_readable(conn)
+
+            self._apply_meters()
+
+            now = time.monotonic()
+            for conn in self.connections:
+                if conn.sock is not None:
+                    continue
+                if conn.resolving is not None:
+                    if conn.resolving.done():
+                        self._connect(conn)
+                elif now >= conn.reconnect_at:
+                    self._connect(conn)
+
+        for conn in self.connections:
+            self._close(conn)
+            conn.series.release()
+        self.resolver.shutdown(wait=False, cancel_futures=True)
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        logging.info(f'P1 network meters ({self.serial_port}) stopped')
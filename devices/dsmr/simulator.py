@@ -0,0 +1,87 @@
+"""
+Local TCP stand-in for network P1 dongles / ser2net, for tests and benchmarks.
+
+Streams recorded telegrams to every connected client at the DSMR 5 rate (one telegram per second by default),
+looping over the recording. Telegrams are sent in small chunks, like a serial line forwarded over TCP.
+
+Usage: python -m devices.dsmr.simulator <telegram file> [first port] [number of meters] [interval]
+"""
+import sys
+import time
+import logging
+import threading
+import socketserver
+
+_CHUNK_SIZE = 64
+
+
+def load_telegrams(path):
+    # Split a recording (one or more telegrams) into separate telegrams, each ending with its '!' checksum line
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    telegrams = []
+    start = data.find(b'/')
+    while start != -1:
+        end = data.find(b'!', start)
+        end = data.find(b'\n', end) if end != -1 else -1
+        if end == -1:
+            break
+        telegrams.append(data[start:end + 1])
+        start = data.find(b'/', end)
+    return telegrams
+
+
+class _P1Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        telegrams = self.server.telegrams
+        index = 0
+        while not self.server.stopped.is_set():
+            telegram = telegrams[index % len(telegrams)]
+            index += 1
+            try:
+                for pos in range(0, len(telegram), _CHUNK_SIZE):
+                    self.request.sendall(telegram[pos:pos + _CHUNK_SIZE])
+            except OSError:
+                return
+            self.server.stopped.wait(self.server.interval)
+
+
+class P1Simulator(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, telegrams, host='127.0.0.1', port=0, interval=1.0):
+        super().__init__((host, port), _P1Handler)
+        self.telegrams = load_telegrams(telegrams) if isinstance(telegrams, str) else telegrams
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        # Serve from a background thread, returns the thread
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.stopped.set()
+        super().shutdown()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1]
+    first_port = int(sys.argv[2]) if len(sys.argv) > 2 else 2001
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    interval = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+
+    telegrams = load_telegrams(path)
+    for port in range(first_port, first_port + count):
+        P1Simulator(telegrams, '0.0.0.0', port, interval).start()
+    logging.info(f'Streaming {len(telegrams)} telegram(s) on ports {first_port}-{first_port + count - 1}')
+    while True:
+        time.sleep(3600)
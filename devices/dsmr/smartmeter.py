@@ -1,15 +1,29 @@
 import serial
 import threading
 from . import datadefinitions
+from . import byteparser
+import clock
+import tracing
+from series import SeriesCache
 import re
 import logging
 
 
 class DSMRMeter(threading.Thread):
-    def __init__(self, queue, serial_port):
+    def __init__(self, queue, serial_port, parser='text'):
         super().__init__()
         self.serial_port = serial_port
         self.queue = queue
+        # 'text': decode and parse line by line (default), 'bytes': parse the raw telegram bytes (see byteparser)
+        if parser not in ('text', 'bytes'):
+            raise ValueError(f'Unknown DSMR parser {parser}')
+        self.parser = parser
+        self.stop_event = threading.Event()
+        # Series IDs of the readings, interned once per series
+        self.series = SeriesCache(slots=byteparser.SERIES_SLOTS)
+
+    def stop(self):
+        self.stop_event.set()
 
     def preprocess(self, telegram):
         # Preprocess telegram to add totals of consumed and returned values
@@ -57,7 +71,7 @@ class DSMRMeter(threading.Thread):
 
         return telegram
 
-    def read_telegram(self):
+    def open_serial(self):
         ser = serial.Serial()
         ser.baudrate = 115200
         ser.bytesize = serial.EIGHTBITS
@@ -74,8 +88,15 @@ class DSMRMeter(threading.Thread):
             logging.error(f'Error opening serial port {self.serial_port}: {e}')
 
         ser.flushInput()
+        return ser
+
+    def read_telegram(self):
+        ser = self.open_serial()
         telegram = ''
         while '!' not in telegram:
+            if self.stop_event.is_set():
+                ser.close()
+                return ''
             telegram += ser.readline().decode('ascii')
 
         processed_telegram = self.preprocess(telegram)
@@ -83,14 +104,31 @@ class DSMRMeter(threading.Thread):
         ser.close()
         return processed_telegram
 
-    def parse_telegram(self, telegram):
+    def read_telegram_bytes(self):
+        # Read the raw telegram into a single bytearray, without decoding (or preprocessing) it
+        ser = self.open_serial()
+        telegram = bytearray()
+        while True:
+            if self.stop_event.is_set():
+                ser.close()
+                return bytearray()
+            line = ser.readline()
+            telegram += line
+            if b'!' in line:
+                break
+
+        ser.close()
+        return telegram
+
+    def parse_telegram(self, telegram, timestamp=0, acquired_at=None):
         if telegram != '':
-            logging.debug(f'Parsing DSMR telegram...')
+            logging.debug('Parsing DSMR telegram...')
             identified_telegram, value = datadefinitions.identify_telegram(telegram)
             tgr_desc = identified_telegram[datadefinitions.DESCRIPTION]
             tgr_val_search = re.search(identified_telegram[datadefinitions.REGEX], value)
 
-            if tgr_val_search:
+            # Unknown codes have an empty regex (no group): their value is empty, like the byte-level parser
+            if tgr_val_search and tgr_val_search.re.groups:
                 tgr_val = tgr_val_search.group(1)
             else:
                 tgr_val = ''
@@ -98,7 +136,11 @@ class DSMRMeter(threading.Thread):
             # If the DATATYPE is a float or int, multiply the value by MULTIPLICATION
             d_type = identified_telegram[datadefinitions.DATATYPE]
             if d_type in ['float', 'int']:
-                tgr_val = eval(d_type)(tgr_val) * eval(d_type)(identified_telegram[datadefinitions.MULTIPLICATION])
+                try:
+                    tgr_val = eval(d_type)(tgr_val) * eval(d_type)(identified_telegram[datadefinitions.MULTIPLICATION])
+                except ValueError:
+                    logging.warning(f'Warning: Unable to convert DSMR value for {tgr_desc} ({tgr_val}). Skipping...')
+                    return
 
             # Check if data validation is necessary and value is not zero. Skip entry if requirements not met
             valid_telegram = True
@@ -109,7 +151,7 @@ class DSMRMeter(threading.Thread):
 
             # Format and push the telegram onto the queue so other threads can pick it up
             if valid_telegram:
-                # Format: [prefix, topic, tag, value, messagerate, datatype] (list)
+                # Format: [prefix, topic, tag, value, messagerate, timestamp, series ID] (list)
                 prefix = 'dsmr'
                 topic = identified_telegram[datadefinitions.MQTT_TOPIC]
                 tag = identified_telegram[datadefinitions.MQTT_TAG]
@@ -117,12 +159,28 @@ class DSMRMeter(threading.Thread):
                 message_rate = identified_telegram[datadefinitions.MESSAGERATE]
                 datatype = identified_telegram[datadefinitions.DATATYPE]
                 val = eval(datatype)(tgr_val)
-                self.queue.put([prefix, topic, tag, val, message_rate])
+                # Rate 0 readings are never sent, unless a rate override enables them: not interned
+                series_id = self.series.get((prefix, topic, tag)) if int(message_rate) != 0 else None
+                self.queue.put(tracing.traced([prefix, topic, tag, val, message_rate, timestamp, series_id],
+                                              acquired_at))
 
     def run(self):
         logging.info(f"Starting P1 SmartMeter (device on {self.serial_port})")
-        while True:
+        while not self.stop_event.is_set():
+            if self.parser == 'bytes':
+                telegram = self.read_telegram_bytes()
+                timestamp = clock.time_ns()
+                acquired_at = tracing.acquired()
+                if telegram:
+                    for reading in byteparser.parse_telegram(telegram, timestamp=timestamp, series=self.series):
+                        self.queue.put(tracing.traced(reading, acquired_at))
+                continue
+
             telegram = self.read_telegram()
+            timestamp = clock.time_ns()
+            acquired_at = tracing.acquired()
             telegram_list = telegram.splitlines()
             for item in telegram_list:
-                self.parse_telegram(item)
+                self.parse_telegram(item, timestamp, acquired_at)
+        self.series.release()
+        logging.info(f"P1 SmartMeter on {self.serial_port} stopped")
@@ -0,0 +1,114 @@
+"""
+Local Modbus TCP stand-in for a Sun2000 inverter, for tests and benchmarks.
+
+Serves read holding/input register requests (function codes 3 and 4) from an in-memory register map, answering
+pipelined requests in order. Unknown registers return Modbus exception 2 (illegal data address).
+
+Usage: python -m devices.sun2000.simulator [port]
+"""
+import sys
+import struct
+import logging
+import threading
+import socketserver
+
+_MBAP = struct.Struct('>HHHB')
+_READ_REQUEST = struct.Struct('>BHH')
+
+
+def _long(value):
+    value &= 0xffffffff
+    return [value >> 16, value & 0xffff]
+
+
+def _string(text, number_of_registers):
+    raw = text.encode('latin1').ljust(2 * number_of_registers, b'\x00')
+    return list(struct.unpack(f'>{number_of_registers}H', raw))
+
+
+def default_registers(pv_string_count=2):
+    # A running SUN2000 with plausible values, at the addresses used by Sun2000
+    registers = {}
+
+    def put(address, values):
+        for offset, value in enumerate(values):
+            registers[address + offset] = value & 0xffff
+
+    put(30000, _string('SUN2000-5KTL-M1', 15))
+    put(30070, [428])
+    put(30071, [pv_string_count])
+    for pv_string_no in range(1, pv_string_count + 1):
+        put(32014 + 2 * pv_string_no, [3521 + pv_string_no, 812 - pv_string_no])
+    put(32064, _long(4120))
+    put(32069, [2331, 2318, 2342])
+    put(32072, [5912, 0, 5870, 0, 5931, 0])
+    put(32078, _long(6250))
+    put(32080, _long(4015) + _long(-120))
+    put(32084, [998])
+    put(32086, [9745, 412])
+    put(32089, [0x0200])
+    put(32106, _long(1234567))
+    return registers
+
+
+class _ModbusHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        registers = self.server.registers
+        buffer = bytearray()
+        while True:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return
+            buffer += chunk
+
+            responses = bytearray()
+            while len(buffer) >= _MBAP.size:
+                transaction_id, protocol_id, length, unit_id = _MBAP.unpack_from(buffer)
+                frame_size = _MBAP.size - 1 + length
+                if len(buffer) < frame_size:
+                    break
+                pdu = bytes(buffer[_MBAP.size:frame_size])
+                del buffer[:frame_size]
+                response = self._respond(registers, pdu)
+                responses += _MBAP.pack(transaction_id, 0, 1 + len(response), unit_id) + response
+
+            if responses:
+                self.request.sendall(responses)
+
+    def _respond(self, registers, pdu):
+        functioncode = pdu[0]
+        if functioncode not in (3, 4) or len(pdu) != _READ_REQUEST.size:
+            return bytes([functioncode | 0x80, 1])  # Illegal function
+
+        functioncode, address, count = _READ_REQUEST.unpack(pdu)
+        try:
+            values = [registers[address + offset] for offset in range(count)]
+        except KeyError:
+            return bytes([functioncode | 0x80, 2])  # Illegal data address
+        return struct.pack(f'>BB{count}H', functioncode, 2 * count, *values)
+
+
+class ModbusTCPSimulator(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, registers=None):
+        super().__init__((host, port), _ModbusHandler)
+        self.registers = default_registers() if registers is None else registers
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        # Serve from a background thread, returns the thread
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    simulator = ModbusTCPSimulator('0.0.0.0', int(sys.argv[1]) if len(sys.argv) > 1 else 5020)
+    logging.info(f'Sun2000 Modbus TCP simulator listening on port {simulator.port}')
+    simulator.serve_forever()
@@ -2,35 +2,76 @@ import serial
 import time
 import threading
 from . import datadefinitions
+from . import transport
+import clock
+import tracing
+from series import SeriesCache
 import re
 import logging
-import minimalmodbus
 import functools
 
 
+# Retries per register read. Both give up after about 150 s on an unresponsive inverter: an RTU attempt takes the
+# 0.2 s serial timeout, a TCP attempt up to the 3 s socket timeout plus the 1 s connect delay.
+_RTU_RETRIES = 500
+_TCP_RETRIES = 30
+
+# Metrics registers read by one pipelined Modbus TCP request: (name, registeraddress, number of registers,
+# number of decimals, signed). Same registers and scaling as the getters, the PV strings are added per string.
+_METRICS = [
+    ('phase_a_voltage', 32069, 1, 1, False),
+    ('phase_b_voltage', 32070, 1, 1, False),
+    ('phase_c_voltage', 32071, 1, 1, False),
+    ('phase_a_current', 32072, 1, 3, True),
+    ('phase_b_current', 32074, 1, 3, True),
+    ('phase_c_current', 32076, 1, 3, True),
+    ('input_power', 32064, 2, 0, True),
+    ('active_power', 32080, 2, 0, True),
+    ('reactive_power', 32082, 2, 0, True),
+    ('power_factor', 32084, 1, 3, True),
+    ('efficiency', 32086, 1, 2, False),
+    ('day_power', 32078, 2, 0, True),
+    ('total_power', 32106, 2, 0, True),
+]
+
+
+class _Stopped(Exception):
+    # Raised by the getters when the thread is being stopped, so a half-polled cycle is never logged
+    pass
+
+
 class Sun2000(threading.Thread):
     def __init__(self, queue, serial_port):
         super().__init__()
         self.serial_port = serial_port
         self.serial_baud = 9600
         self.queue = queue
+        self.stop_event = threading.Event()
         self.prefix = 'solar'
+        # Series IDs of the readings, interned once per series
+        self.series = SeriesCache()
         self.slave_address = 1
-        self.instrument = minimalmodbus.Instrument(
-            self.serial_port, self.slave_address)
-        self.instrument.serial.baudrate = self.serial_baud
-        self.instrument.serial.timeout = 0.2
+        # Modbus RTU on a serial port, or Modbus TCP when the port is 'tcp://host[:port][?unit_id=n]'
+        self.instrument = transport.make_transport(self.serial_port, self.slave_address, self.serial_baud, 0.2)
+        self.pipelined = isinstance(self.instrument, transport.TCPTransport)
+        self.retry_count = _TCP_RETRIES if self.pipelined else _RTU_RETRIES
+
+    def stop(self):
+        self.stop_event.set()
     
     def retry_decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            retry_count = 500
+            retry_count = args[0].retry_count
             total_count = 0
             error_count = 0
             result = None
-            logging.info(func)
+            logging.debug('%s', func)
 
             while result == None and retry_count > 0:
+                # Give up early when the thread is being stopped (e.g. the device was removed from the config)
+                if args[0].stop_event.is_set():
+                    raise _Stopped()
                 total_count += 1
                 try:
                     result = func(*args, **kwargs)
@@ -121,20 +162,50 @@ class Sun2000(threading.Thread):
     def get_internal_temp(self):
         return self.instrument.read_register(32087, 1, signed=True)
     
+    @retry_decorator
+    def get_metrics(self):
+        # All metrics in one round-trip (Modbus TCP only). A Modbus exception on any register (e.g. the SDongle is
+        # busy) raises, so the whole cycle is retried like a failing getter.
+        metrics = []
+        for pv_string_no in range(self.pv_string_count):
+            metrics.append((f'pv{pv_string_no}_voltage', 32016 + 2 * pv_string_no, 1, 1, True))
+            metrics.append((f'pv{pv_string_no}_current', 32017 + 2 * pv_string_no, 1, 2, True))
+        metrics += _METRICS
+
+        results = self.instrument.pipeline([(address, count, 3) for name, address, count, decimals, signed in metrics])
+        data = {}
+        for (name, address, count, decimals, signed), registers in zip(metrics, results):
+            if count == 2:
+                data[name] = transport.decode_long(registers, signed)
+            else:
+                data[name] = transport.decode_register(registers, decimals, signed)
+        return data
+
     @retry_decorator
     def get_device_status(self):
         return self.instrument.read_register(32089)
 
-    def log_message(self, topic, tag, datatype, val, message_rate):
+    def log_message(self, topic, tag, datatype, val, message_rate, timestamp, acquired_at=None):
         val = eval(datatype)(val)
-        self.queue.put([self.prefix, topic, tag, val, message_rate])
+        series_id = self.series.get((self.prefix, topic, tag)) if message_rate != 0 else None
+        self.queue.put(tracing.traced([self.prefix, topic, tag, val, message_rate, timestamp, series_id],
+                                      acquired_at))
         
     def run(self):
         logging.info(f"Starting Sun2000 (device on {self.serial_port})...")
+        try:
+            self.poll()
+        except _Stopped:
+            pass
+        self.instrument.close()
+        self.series.release()
+        logging.info(f"Sun2000 on {self.serial_port} stopped")
+
+    def poll(self):
         self.model_id = self.get_model_id()
         logging.info(f'Model ID: {self.model_id}')
 
-        self.model = self.get_model().rstrip('\x00')
+        self.model = (self.get_model() or '').rstrip('\x00')
         logging.info(f'Model: {self.model}')
 
         self.pv_string_count = self.get_pv_strings_number()
@@ -145,10 +216,12 @@ class Sun2000(threading.Thread):
         self.internal_temp = None
         
         
-        while True:
+        while not self.stop_event.is_set():
             device_status_code = self.get_device_status()
             device_status_string = datadefinitions.get_device_status_string(device_status_code)
             internal_temp = self.get_internal_temp()
+            timestamp = clock.time_ns()
+            acquired_at = tracing.acquired()
             
             
             if (self.device_status_code != device_status_code):
@@ -156,8 +229,10 @@ class Sun2000(threading.Thread):
                 self.device_status_string = device_status_string
                 logging.info(f'Device status: {self.device_status_code} {self.device_status_string}')
                 
-                self.log_message('system', 'status_code', 'int', self.device_status_code, 3600)
-                self.log_message('system', 'status_string', 'str', self.device_status_string, 3600)
+                self.log_message('system', 'status_code', 'int', self.device_status_code, 3600, timestamp,
+                                 acquired_at)
+                self.log_message('system', 'status_string', 'str', self.device_status_string, 3600, timestamp,
+                                 acquired_at)
 
                 
 
@@ -165,46 +240,54 @@ class Sun2000(threading.Thread):
                 # topic, tag, datatype, data, message_rate
                 self.internal_temp = internal_temp
 
-                self.log_message('system', 'internal_temp', 'float', internal_temp, 3600)
+                self.log_message('system', 'internal_temp', 'float', internal_temp, 3600, timestamp, acquired_at)
 
                 logging.info(f'Device temperature: {self.internal_temp}')
 
             if (0xa000 == device_status_code):
-                time.sleep(10)
+                self.stop_event.wait(10)
                 continue
 
-            pv = {}
-            
-            for pv_string_no in range(self.pv_string_count):
-                pv[f'pv{pv_string_no}_voltage'] = self.get_pv_voltage(
-                    pv_string_no + 1)
-                pv[f'pv{pv_string_no}_current'] = self.get_pv_current(
-                    pv_string_no + 1)
+            if self.pipelined:
+                elec_data = self.get_metrics()
+                if elec_data is None:
+                    # Gave up after retry_count attempts: skip the cycle rather than log zeros
+                    continue
+            else:
+                elec_data = self.get_metrics_registers()
 
-            
-            elec_data = {
-                **pv,
-                'phase_a_voltage': self.get_phase_a_voltage(),
-                'phase_b_voltage': self.get_phase_b_voltage(),
-                'phase_b_voltage': self.get_phase_c_voltage(),
-                'phase_a_current': self.get_phase_a_current(),
-                'phase_b_current': self.get_phase_b_current(),
-                'phase_c_current': self.get_phase_c_current(),
-                'input_power': self.get_input_power(),
-                'active_power': self.get_active_power(),
-                'reactive_power': self.get_reactive_power(),
-                'power_factor': self.get_power_factor(),
-                'efficiency': self.get_efficiency(),
-                'day_power': self.get_day_power(),
-                'total_power': self.get_total_power()
-            }
-            
             # Dictionary comprehension to change "None" to 0.0, as these are all numeric (float) values
             elec_data_cleaned = {k: v or 0.0 for (k, v) in elec_data.items()}
+            timestamp = clock.time_ns()
+            acquired_at = tracing.acquired()
             
             # Loop over the dictionary and log each entry
             for entry in elec_data_cleaned:
-                self.log_message('metrics', entry, 'float', elec_data_cleaned[entry], 3600)
-            
-            
-            
+                self.log_message('metrics', entry, 'float', elec_data_cleaned[entry], 3600, timestamp, acquired_at)
+
+    def get_metrics_registers(self):
+        # All metrics, one getter (and round-trip) per register
+        pv = {}
+
+        for pv_string_no in range(self.pv_string_count):
+            pv[f'pv{pv_string_no}_voltage'] = self.get_pv_voltage(
+                pv_string_no + 1)
+            pv[f'pv{pv_string_no}_current'] = self.get_pv_current(
+                pv_string_no + 1)
+
+        return {
+            **pv,
+            'phase_a_voltage': self.get_phase_a_voltage(),
+            'phase_b_voltage': self.get_phase_b_voltage(),
+            'phase_c_voltage': self.get_phase_c_voltage(),
+            'phase_a_current': self.get_phase_a_current(),
+            'phase_b_current': self.get_phase_b_current(),
+            'phase_c_current': self.get_phase_c_current(),
+            'input_power': self.get_input_power(),
+            'active_power': self.get_active_power(),
+            'reactive_power': self.get_reactive_power(),
+            'power_factor': self.get_power_factor(),
+            'efficiency': self.get_efficiency(),
+            'day_power': self.get_day_power(),
+            'total_power': self.get_total_power()
+        }
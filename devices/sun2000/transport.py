@@ -0,0 +1,201 @@
+"""
+Modbus transports for the Sun2000 inverter.
+
+Both transports expose the subset of the minimalmodbus.Instrument API used by Sun2000 (read_register, read_long,
+read_string), so the register getters run unchanged on either backend:
+
+- RTUTransport: Modbus RTU over a serial port, through minimalmodbus.
+- TCPTransport: Modbus TCP (inverter port or SDongle) over a persistent socket, with transaction IDs, request
+  pipelining and automatic reconnects.
+
+Use make_transport() to pick the transport from the configured port: 'tcp://host[:port][?unit_id=n]' selects
+Modbus TCP, anything else is a serial port.
+"""
+import time
+import socket
+import struct
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import minimalmodbus
+
+# MBAP header: transaction ID, protocol ID (0), length (unit ID + PDU), unit ID
+_MBAP = struct.Struct('>HHHB')
+_READ_REQUEST = struct.Struct('>BHH')
+
+_DEFAULT_TCP_PORT = 502
+
+
+class ModbusError(IOError):
+    pass
+
+
+def decode_register(registers, number_of_decimals=0, signed=False):
+    # Like minimalmodbus read_register(): one register, optionally signed and scaled
+    value = registers[0]
+    if signed and value & 0x8000:
+        value -= 0x10000
+    if number_of_decimals:
+        return value / 10 ** number_of_decimals
+    return value
+
+
+def decode_long(registers, signed=False):
+    # Like minimalmodbus read_long(): two registers, big-endian
+    high, low = registers
+    value = (high << 16) | low
+    if signed and value & 0x80000000:
+        value -= 0x100000000
+    return value
+
+
+class RTUTransport:
+    def __init__(self, serial_port, slave_address, baudrate=9600, timeout=0.2):
+        self.instrument = minimalmodbus.Instrument(serial_port, slave_address)
+        self.instrument.serial.baudrate = baudrate
+        self.instrument.serial.timeout = timeout
+
+    def read_register(self, registeraddress, number_of_decimals=0, functioncode=3, signed=False):
+        return self.instrument.read_register(registeraddress, number_of_decimals, functioncode, signed)
+
+    def read_long(self, registeraddress, functioncode=3, signed=False, byteorder=minimalmodbus.BYTEORDER_BIG):
+        return self.instrument.read_long(registeraddress, functioncode, signed, byteorder)
+
+    def read_string(self, registeraddress, number_of_registers=16, functioncode=3):
+        return self.instrument.read_string(registeraddress, number_of_registers, functioncode)
+
+    def close(self):
+        self.instrument.serial.close()
+
+
+class TCPTransport:
+    def __init__(self, host, port=_DEFAULT_TCP_PORT, unit_id=1, timeout=3.0, connect_delay=1.0):
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        # The SDongle drops requests that arrive right after connecting, so wait a bit before the first request
+        self.connect_delay = connect_delay
+        self.sock = None
+        self.rx_buffer = bytearray()
+        self.transaction_id = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        logging.info(f'Connecting to Modbus TCP device {self.host}:{self.port} (unit {self.unit_id})...')
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rx_buffer.clear()
+        if self.connect_delay:
+            time.sleep(self.connect_delay)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _next_transaction_id(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xffff
+        return self.transaction_id
+
+    def _recv_frame(self):
+        # Returns (transaction ID, PDU) of the next complete frame on the socket
+        while True:
+            if len(self.rx_buffer) >= _MBAP.size:
+                transaction_id, protocol_id, length, unit_id = _MBAP.unpack_from(self.rx_buffer)
+                frame_size = _MBAP.size - 1 + length
+                if len(self.rx_buffer) >= frame_size:
+                    pdu = bytes(self.rx_buffer[_MBAP.size:frame_size])
+                    del self.rx_buffer[:frame_size]
+                    return transaction_id, pdu
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ModbusError(f'Connection closed by {self.host}:{self.port}')
+            self.rx_buffer += chunk
+
+    def pipeline(self, requests, raise_errors=True):
+        """
+        Read several register blocks in one round-trip: all requests are sent before the responses are read,
+        and responses are matched to their request by transaction ID.
+        requests: list of (registeraddress, number_of_registers, functioncode). Returns a list of register tuples.
+        With raise_errors=False, a request answered with a Modbus exception gives None instead of raising (connection
+        errors always raise).
+        """
+        with self.lock:
+            if self.sock is None:
+                self._connect()
+
+            pending = {}
+            frames = bytearray()
+            for index, (registeraddress, number_of_registers, functioncode) in enumerate(requests):
+                transaction_id = self._next_transaction_id()
+                pending[transaction_id] = index
+                frames += _MBAP.pack(transaction_id, 0, 1 + _READ_REQUEST.size, self.unit_id)
+                frames += _READ_REQUEST.pack(functioncode, registeraddress, number_of_registers)
+
+            results = [None] * len(requests)
+            try:
+                self.sock.sendall(frames)
+                while pending:
+                    transaction_id, pdu = self._recv_frame()
+                    index = pending.pop(transaction_id, None)
+                    if index is None:
+                        # Not a transaction we are waiting for (e.g. a duplicate answer), discard it
+                        logging.debug(f'Discarding stale Modbus TCP response (transaction {transaction_id})')
+                        continue
+                    results[index] = pdu
+            except (OSError, ModbusError):
+                # Drop the connection, the next request reconnects. Unanswered requests would otherwise
+                # be received as responses to later requests.
+                self.close()
+                raise
+
+        if raise_errors:
+            return [self._decode(pdu, requests[index]) for index, pdu in enumerate(results)]
+
+        registers = []
+        for index, pdu in enumerate(results):
+            try:
+                registers.append(self._decode(pdu, requests[index]))
+            except ModbusError as err:
+                logging.debug(f'{err}')
+                registers.append(None)
+        return registers
+
+    def _decode(self, pdu, request):
+        registeraddress, number_of_registers, functioncode = request
+        if pdu[0] & 0x80:
+            raise ModbusError(f'Modbus exception {pdu[1]} reading register {registeraddress}')
+        if pdu[0] != functioncode or pdu[1] != 2 * number_of_registers:
+            raise ModbusError(f'Unexpected Modbus response reading register {registeraddress}')
+        return struct.unpack_from(f'>{number_of_registers}H', pdu, 2)
+
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return self.pipeline([(registeraddress, number_of_registers, functioncode)])[0]
+
+    def read_register(self, registeraddress, number_of_decimals=0, functioncode=3, signed=False):
+        return decode_register(self.read_registers(registeraddress, 1, functioncode), number_of_decimals, signed)
+
+    def read_long(self, registeraddress, functioncode=3, signed=False, byteorder=minimalmodbus.BYTEORDER_BIG):
+        if byteorder != minimalmodbus.BYTEORDER_BIG:
+            raise ValueError('Only big-endian longs are supported over Modbus TCP')
+        return decode_long(self.read_registers(registeraddress, 2, functioncode), signed)
+
+    def read_string(self, registeraddress, number_of_registers=16, functioncode=3):
+        registers = self.read_registers(registeraddress, number_of_registers, functioncode)
+        return struct.pack(f'>{number_of_registers}H', *registers).decode('latin1')
+
+
+def make_transport(port, slave_address, baudrate=9600, timeout=0.2):
+    # baudrate and timeout only apply to Modbus RTU
+    if not port.startswith('tcp://'):
+        return RTUTransport(port, slave_address, baudrate, timeout)
+
+    url = urlsplit(port)
+    query = parse_qs(url.query)
+    unit_id = int(query['unit_id'][0]) if 'unit_id' in query else slave_address
+    return TCPTransport(url.hostname, url.port or _DEFAULT_TCP_PORT, unit_id)
@@ -2,14 +2,92 @@ import queue
 import logging
 import os
 import sys
+import time
+import signal
 import configparser
 
+import aggregator
 import dataloggers
+import lineprotocol
+import tracing
+import workers
+from configwatcher import ConfigWatcher
+import series
 from devices.dsmr import smartmeter
+from devices.dsmr import p1network
 from devices.sun2000 import sun2000
 
 _config = configparser.ConfigParser()
 
+# Running threads, by name. Sinks are 'mqtt' and 'influx', devices are keyed by their [DEVICES] option.
+_threads = {}
+# Config each running thread was started with (or last updated to), by thread name. Config changes are compared
+# against these, so a thread that failed to start (or stop) is retried on the next change.
+_applied = {}
+
+# Sections that are only read at startup: changes need a restart of EnergyLogger
+_RESTART_SECTIONS = ('MULTIPROCESS', 'TRACING', 'SERIES')
+
+# Device option in the [DEVICES] section -> device thread class. An empty option disables the device.
+# P1Network lists P1 meters reachable over TCP, all read by one thread: 'name=host:port, name=host:port, ...'
+_DEVICES = {
+    'dsmrport': smartmeter.DSMRMeter,
+    'sun2kport': sun2000.Sun2000,
+    'p1network': p1network.P1NetworkMeters,
+}
+
+# Additional [DEVICES] options per device: keyword argument -> (option, default)
+_DEVICE_OPTIONS = {
+    'dsmrport': {'parser': ('dsmrparser', 'text')},
+    'sun2kport': {},
+    'p1network': {},
+}
+
+# Max time to wait for a thread to stop. The DSMR reader can block up to its 12 s serial timeout.
+_STOP_TIMEOUT = 15
+
+
+def validate_config(config):
+    # INFLUXDB is not needed on an edge instance that forwards its readings to a central instance
+    required = ('MQTT', 'DEVICES') if config.has_section('FORWARD') else ('MQTT', 'DEVICES', 'INFLUXDB')
+    for section in required:
+        if not config.has_section(section):
+            logging.error(f'Config file is missing the {section} section.')
+            return False
+
+    for section in config.sections():
+        if any(v == '!CHANGEME' for k, v in iter(config.items(section))):
+            logging.error(f'Please check the config file {section} section.')
+            return False
+
+    if config['DEVICES'].get('dsmrparser', 'text') not in ('text', 'bytes'):
+        logging.error('DSMRParser in the DEVICES section must be either text or bytes.')
+        return False
+
+    try:
+        int(config['MQTT']['Port'])
+        p1network.parse_meters(config['DEVICES'].get('p1network', ''))
+        if config.has_section('FORWARD'):
+            get_forward_settings(config)
+        if config.has_section('AGGREGATOR'):
+            get_aggregator_settings(config)
+        if config.has_section('INFLUXDB'):
+            get_influx_settings(config)
+        get_tracing_settings(config)
+        get_series_settings(config)
+        get_rate_overrides(config)
+        if get_multiprocess_settings(config) is not None:
+            # In multi-process mode, prefixes must fit the ring buffer records
+            for name in p1network.parse_meters(config['DEVICES'].get('p1network', '')):
+                if len(p1network.meter_prefix(name).encode('utf-8')) > workers.PREFIX_SIZE:
+                    raise ValueError(f'P1Network meter name {name} is too long for multi-process mode '
+                                     f'(prefix limited to {workers.PREFIX_SIZE} bytes)')
+    except (ValueError, KeyError) as err:
+        logging.error(f'Invalid value in config file: {err}')
+        return False
+
+    return True
+
 
 def check_config():
     if not os.path.exists('config.cfg'):
@@ -38,13 +116,297 @@ def check_config():
         return False
     else:
         _config.read('config.cfg')
+        return validate_config(_config)
+
+
+def get_rate_overrides(config):
+    # Optional [RATES] section: 'prefix/topic/tag = messages per hour', e.g. 'dsmr/el/p_consumed = 60'
+    if not config.has_section('RATES'):
+        return {}
+    return {k.lower(): int(v) for k, v in config.items('RATES')}
+
+
+def get_multiprocess_settings(config):
+    # Optional [MULTIPROCESS] section: run every device reader in its own process, feeding the sinks through a
+    # shared-memory ring buffer. ReaderCPUs/SinkCPUs pin the readers and the sink process to separate cores.
+    if not config.has_section('MULTIPROCESS') or not config.getboolean('MULTIPROCESS', 'Enabled', fallback=False):
+        return None
+    return {
+        'reader_cpus': workers.parse_cpus(config.get('MULTIPROCESS', 'ReaderCPUs', fallback='')),
+        'sink_cpus': workers.parse_cpus(config.get('MULTIPROCESS', 'SinkCPUs', fallback='')),
+        'ring_size': config.getint('MULTIPROCESS', 'RingSize', fallback=4096),
+    }
+
+
+def parse_addresses(value):
+    # 'host:port, host:port' -> [(host, port), (host, port)]
+    addresses = []
+    for address in value.split(','):
+        if address.strip():
+            host, port = address.strip().rsplit(':', 1)
+            addresses.append((host, int(port)))
+    return addresses
+
+
+def get_mqtt_settings(config):
+    return (config['MQTT']['Server'], int(config['MQTT']['Port']),
+            config['MQTT']['User'], config['MQTT']['Password'])
+
+
+def get_forward_settings(config):
+    # Optional [FORWARD] section (edge instance): forward readings to a central instance instead of writing to
+    # InfluxDB. Transport is 'tcp' (Centrals = host:port, ... one per shard) or 'mqtt' (through the [MQTT] broker,
+    # ShardCount central instances).
+    section = config['FORWARD']
+    transport = section.get('Transport', 'tcp')
+    if transport not in ('tcp', 'mqtt'):
+        raise ValueError(f'Unknown forward transport {transport}')
+    centrals = parse_addresses(section.get('Centrals', '')) if transport == 'tcp' else None
+    if transport == 'tcp' and not centrals:
+        raise ValueError('Centrals is required for the tcp forward transport')
+    return {
+        'site': section['Site'],
+        'centrals': centrals,
+        'mqtt_settings': get_mqtt_settings(config) if transport == 'mqtt' else None,
+        'shard_count': section.getint('ShardCount', 1),
+        'batch_size': section.getint('BatchSize', 500),
+        'batch_interval': section.getfloat('BatchInterval', 10),
+        'buffer_frames': section.getint('BufferFrames', 1000),
+    }
+
+
+def get_aggregator_settings(config):
+    # Optional [AGGREGATOR] section (central instance): receive forwarded readings and write them to InfluxDB
+    section = config['AGGREGATOR']
+    settings = {
+        'listen': section.get('Listen', '0.0.0.0:7070'),
+        'shard_index': section.getint('ShardIndex', 0),
+        'shard_count': section.getint('ShardCount', 1),
+        'mqtt_settings': get_mqtt_settings(config) if section.getboolean('MQTT', fallback=False) else None,
+        'batch_size': section.getint('BatchSize', 5000),
+        'flush_interval': section.getfloat('FlushInterval', 1.0),
+        'max_buffer': section.getint('MaxBuffer', 500000),
+    }
+    if not 0 <= settings['shard_index'] < settings['shard_count']:
+        raise ValueError('ShardIndex must be between 0 and ShardCount - 1')
+    return settings
+
+
+def get_tracing_settings(config):
+    # Optional [TRACING] section. Tracing and the sampling profiler can also be toggled at runtime with SIGUSR1 and
+    # SIGUSR2 (see tracing.install_signal_handlers)
+    return {
+        'enabled': config.getboolean('TRACING', 'Enabled', fallback=False),
+        'report_interval': config.getfloat('TRACING', 'ReportInterval', fallback=300),
+        'profile_interval': config.getfloat('TRACING', 'ProfileInterval', fallback=0.01),
+        'profile_output': config.get('TRACING', 'ProfileOutput', fallback='profile.folded'),
+    }
+
+
+def get_influx_settings(config):
+    # Optional [INFLUXDB] write options: gzip-compressed request bodies, timestamp precision (s, ms, us or ns; 's'
+    # or 'ms' makes the lines smaller), batching of the lines into one request and the number of lines kept for a
+    # retry while InfluxDB is unreachable
+    precision = config.get('INFLUXDB', 'Precision', fallback='ns').lower()
+    if precision not in lineprotocol.PRECISIONS:
+        raise ValueError(f'Precision must be one of {", ".join(lineprotocol.PRECISIONS)}, got {precision}')
+    return {
+        'gzip': config.getboolean('INFLUXDB', 'Gzip', fallback=False),
+        'precision': precision,
+        'batch_size': config.getint('INFLUXDB', 'BatchSize', fallback=500),
+        'flush_interval': config.getfloat('INFLUXDB', 'FlushInterval', fallback=1.0),
+        'max_buffer': config.getint('INFLUXDB', 'MaxBuffer', fallback=10000),
+    }
+
+
+def get_series_settings(config):
+    # Optional [SERIES] section: max number of series (prefix/topic/tag) tracked by the sinks, and the time (s)
+    # after which an unseen series may be evicted to make room for a new one
+    max_series = config.getint('SERIES', 'MaxSeries', fallback=10000)
+    if max_series < 1:
+        raise ValueError(f'MaxSeries must be at least 1, got {max_series}')
+    return {
+        'max_series': max_series,
+        'ttl': config.getfloat('SERIES', 'TTL', fallback=86400),
+    }
+
+
+def start_mqtt(_q, config):
+    t_mqtt = dataloggers.MQTTLogger(
+        _q,
+        config['MQTT']['Server'],
+        int(config['MQTT']['Port']),
+        config['MQTT']['User'],
+        config['MQTT']['Password'],
+        'solar_pi'
+    )
+    t_mqtt.set_rate_overrides(get_rate_overrides(config))
+    t_mqtt.start()
+    return t_mqtt
+
+
+def start_influx(_q, config):
+    t_influx = dataloggers.InfluxLogger(
+        # queue, url, token, org, bucket_id
+        _q,
+        config['INFLUXDB']['url'],
+        config['INFLUXDB']['token'],
+        config['INFLUXDB']['org'],
+        config['INFLUXDB']['bucketid'],
+        **get_influx_settings(config)
+    )
+    t_influx.set_rate_overrides(get_rate_overrides(config))
+    t_influx.start()
+    return t_influx
 
-        for section in _config.sections():
-            if any(v == '!CHANGEME' for k, v in iter(_config.items(section))):
-                logging.error(f'Please check the config file {section} section.')
-                return False
-            else:
-                return True
+
+def start_forward(_q, config):
+    t_forward = dataloggers.ForwardLogger(_q, **get_forward_settings(config))
+    t_forward.set_rate_overrides(get_rate_overrides(config))
+    t_forward.start()
+    return t_forward
+
+
+def start_aggregator(_q, config):
+    # The aggregator does not read the local queue, it receives readings from the edge instances. It writes with
+    # the [INFLUXDB] compression and precision, and its own batching.
+    influx_settings = get_influx_settings(config)
+    t_aggregator = aggregator.AggregatorServer(
+        url=config['INFLUXDB']['url'],
+        token=config['INFLUXDB']['token'],
+        org=config['INFLUXDB']['org'],
+        bucket_id=config['INFLUXDB']['bucketid'],
+        gzip=influx_settings['gzip'],
+        precision=influx_settings['precision'],
+        **get_aggregator_settings(config)
+    )
+    t_aggregator.start()
+    return t_aggregator
+
+
+# Sink name -> (config sections it depends on, start function)
+_SINKS = {
+    'mqtt': (('MQTT',), start_mqtt),
+    'influx': (('INFLUXDB',), start_influx),
+    'forward': (('FORWARD', 'MQTT'), start_forward),
+    'aggregator': (('AGGREGATOR', 'INFLUXDB', 'MQTT'), start_aggregator),
+}
+
+
+def sink_enabled(config, name):
+    if name == 'influx':
+        # An edge instance forwards to a central instance instead of writing to InfluxDB itself
+        return config.has_section('INFLUXDB') and not config.has_section('FORWARD')
+    if name in ('forward', 'aggregator'):
+        return config.has_section(name.upper())
+    return True
+
+
+def section_items(config, sections):
+    return [dict(config.items(section)) if config.has_section(section) else None for section in sections]
+
+
+def get_device_kwargs(config, option):
+    return {kwarg: config['DEVICES'].get(name, default) for kwarg, (name, default) in _DEVICE_OPTIONS[option].items()}
+
+
+def start_device(_q, config, option, port):
+    kwargs = get_device_kwargs(config, option)
+    multiprocess = get_multiprocess_settings(config)
+    if multiprocess is None:
+        t_device = _DEVICES[option](_q, port, **kwargs)
+    else:
+        t_device = workers.ReaderSupervisor(_q, _DEVICES[option], port, device_kwargs=kwargs,
+                                            capacity=multiprocess['ring_size'], cpus=multiprocess['reader_cpus'])
+    t_device.start()
+    return t_device
+
+
+def start_thread(name, start, _q, config, *args):
+    # Returns True when the thread was started. A thread that fails to start stays stopped, so the other threads
+    # are still updated and the next config change retries it.
+    try:
+        _threads[name] = start(_q, config, *args)
+    except Exception as err:
+        logging.error(f'Unable to start {name}: {err}')
+        return False
+    _applied[name] = config
+    return True
+
+
+def stop_thread(name):
+    _applied.pop(name, None)
+    thread = _threads.pop(name, None)
+    if thread is not None:
+        thread.stop()
+        thread.join(_STOP_TIMEOUT)
+        if thread.is_alive():
+            logging.warning(f'Thread {name} did not stop within {_STOP_TIMEOUT}s')
+
+
+def with_sections(config, source, sections):
+    # Copy of config, with sections as they are in source. Raw values, so '%' is interpolated only when read.
+    merged = configparser.ConfigParser()
+    for section in config.sections():
+        if section not in sections:
+            merged[section] = dict(config.items(section, raw=True))
+    for section in sections:
+        if source.has_section(section):
+            merged[section] = dict(source.items(section, raw=True))
+    return merged
+
+
+def apply_config(_q, new_config):
+    global _config
+
+    # Sections only read at startup keep their running values
+    for section in _RESTART_SECTIONS:
+        if section_items(_config, (section,)) != section_items(new_config, (section,)):
+            logging.warning(f'{section} settings changed, restart EnergyLogger to apply them')
+    new_config = with_sections(new_config, _config, _RESTART_SECTIONS)
+
+    # Sinks: restart a sink only when its own sections changed, otherwise just swap in the new rate overrides
+    rate_overrides = get_rate_overrides(new_config)
+    for name, (sections, start) in _SINKS.items():
+        running = _applied.get(name)
+        enabled = sink_enabled(new_config, name)
+        if running is not None and enabled and section_items(running, sections) == section_items(new_config, sections):
+            _threads[name].set_rate_overrides(rate_overrides)
+            _applied[name] = new_config
+            continue
+        if name in _threads:
+            logging.info(f'{name} settings changed, stopping {name} logger')
+            stop_thread(name)
+        if enabled:
+            logging.info(f'Starting {name} logger')
+            start_thread(name, start, _q, new_config)
+
+    # Devices: only touch the devices whose port (or device options) were added, removed or changed
+    for option in _DEVICES:
+        running = _applied.get(option)
+        old_port = running['DEVICES'].get(option, '') if running is not None else ''
+        new_port = new_config['DEVICES'].get(option, '')
+        same_options = running is not None and \
+            get_device_kwargs(running, option) == get_device_kwargs(new_config, option)
+        if old_port == new_port and (same_options or not new_port):
+            if running is not None:
+                _applied[option] = new_config
+            continue
+        thread = _threads.get(option)
+        if old_port and new_port and same_options and hasattr(thread, 'set_meters'):
+            # Only (dis)connect the P1 network meters that were added, removed or changed
+            logging.info(f'Device {option} changed to {new_port}, updating meters')
+            thread.set_meters(new_port)
+            _applied[option] = new_config
+            continue
+        if option in _threads:
+            logging.info(f'Device {option} removed or changed (was {old_port}), stopping')
+            stop_thread(option)
+        if new_port:
+            logging.info(f'Device {option} added on {new_port}, starting')
+            start_thread(option, start_device, _q, new_config, option, new_port)
+
+    _config = new_config
 
 
 def main():
@@ -56,34 +418,45 @@ def main():
     if not check_config():
         sys.exit()
 
+    # In multi-process mode, pin this (sink) process before starting any threads, so they inherit the affinity
+    multiprocess = get_multiprocess_settings(_config)
+    if multiprocess is not None:
+        logging.info('Multi-process mode enabled, device readers run in separate processes')
+        workers.set_affinity(multiprocess['sink_cpus'])
+
+    # Latency tracing (off unless enabled in the config or toggled with SIGUSR1)
+    tracing_settings = get_tracing_settings(_config)
+    tracing.set_enabled(tracing_settings['enabled'])
+    if hasattr(signal, 'SIGUSR1'):
+        tracing.install_signal_handlers(tracing_settings['profile_interval'], tracing_settings['profile_output'])
+    tracing.LatencyReporter(tracing_settings['report_interval']).start()
+
+    # Series registry, shared by the devices and sinks so the series limit applies to the whole instance. Read once,
+    # the devices and sinks keep using the registry across reloads.
+    series.configure(**get_series_settings(_config))
+
     # Communication queue
     _q = queue.Queue()
     # Set up threads
-    t_mqtt = dataloggers.MQTTLogger(
-        _q,
-        _config['MQTT']['Server'],
-        int(_config['MQTT']['Port']),
-        _config['MQTT']['User'],
-        _config['MQTT']['Password'],
-        'solar_pi'
-    )
-    t_influx = dataloggers.InfluxLogger(
-        # queue, url, token, org, bucket_id
-        _q,
-        _config['INFLUXDB']['url'],
-        _config['INFLUXDB']['token'],
-        _config['INFLUXDB']['org'],
-        _config['INFLUXDB']['bucketid'],
-    )
-    t_dsmr = smartmeter.DSMRMeter(_q, _config['DEVICES']['dsmrport'])
-    t_sun2000 = sun2000.Sun2000(_q, _config['DEVICES']['SUN2KPort'])
+    for name, (sections, start) in _SINKS.items():
+        if sink_enabled(_config, name):
+            _threads[name] = start(_q, _config)
+            _applied[name] = _config
 
-    t_mqtt.start()
-    t_influx.start()
-    t_dsmr.start()
-    t_sun2000.start()
+    for option in _DEVICES:
+        port = _config['DEVICES'].get(option, '')
+        if port:
+            _threads[option] = start_device(_q, _config, option, port)
+            _applied[option] = _config
+
+    # Watch the config file, changes are applied without restarting unaffected threads
+    t_watcher = ConfigWatcher('config.cfg', validate_config, lambda new_config: apply_config(_q, new_config))
+    t_watcher.start()
+
+    # Keep the main thread alive, signal handlers only run in the main thread
+    while True:
+        time.sleep(3600)
 
 
 if __name__ == "__main__":
     main()
-
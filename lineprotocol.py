@@ -0,0 +1,39 @@
+"""
+InfluxDB line protocol, formatted directly instead of through influxdb_client's Point.
+
+Shared by dataloggers.InfluxLogger and aggregator.AggregatorServer: both cache the escaped
+'measurement,tags field=' prefix per series and only format the value and timestamp per reading.
+"""
+import math
+
+from influxdb_client import WritePrecision
+
+# Write precision ([INFLUXDB] Precision) -> (WritePrecision, nanoseconds per unit)
+PRECISIONS = {
+    's': (WritePrecision.S, 1000000000),
+    'ms': (WritePrecision.MS, 1000000),
+    'us': (WritePrecision.US, 1000),
+    'ns': (WritePrecision.NS, 1),
+}
+
+
+def escape_key(key):
+    # Measurement, tag and field keys, and tag values
+    return str(key).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=')
+
+
+def format_value(value):
+    # Field value, typed like influxdb_client's Point does. None for values Point skips (nan, inf).
+    if isinstance(value, float):
+        return str(value) if math.isfinite(value) else None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f'{value}i'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def line_prefix(prefix, topic, tag, site=None):
+    # 'measurement,location=lt[,site=site] field=' of a series
+    tags = 'location=lt' if site is None else f'location=lt,site={escape_key(site)}'
+    return f'{escape_key(f"{prefix}_{topic}")},{tags} {escape_key(tag)}='
@@ -0,0 +1,224 @@
+"""
+Bounded registry of the series (prefix, topic, tag) seen by the sinks.
+
+Every series gets a small integer ID, so the sinks can keep their per-series state (throttle timestamps, cached
+topic strings, ...) in preallocated arrays indexed by ID instead of dicts that grow forever. The number of series
+is capped: when the registry is full, series that have not been seen for `ttl` seconds are evicted (least recently
+used first) and their IDs are reused. If nothing can be evicted, the new series is rejected and counted, so a
+garbled serial stream or a misbehaving meter cannot create an unbounded number of topics/series.
+
+Devices intern their series once (see SeriesCache) and carry the ID in each reading, so the sinks only index arrays
+(see SeriesThrottle and SeriesRates).
+Interned series are pinned: they are not evicted until the device releases them. Readings without an ID (rate 0
+definitions, readings from sources without a cache) are looked up by key with SeriesRegistry.lookup().
+"""
+import time
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SeriesRegistry:
+    def __init__(self, max_series=10000, ttl=86400):
+        self.max_series = max_series
+        self.ttl = ttl
+        # key -> series ID of the unpinned series, least recently used first
+        self.ids = OrderedDict()
+        # key -> series ID of the pinned series, and the number of pins per series ID
+        self.pinned = {}
+        self.pins = array('i', [0]) * max_series
+        # series ID -> key
+        self.keys = [None] * max_series
+        self.last_seen = array('d', [0.0]) * max_series
+        self.free_ids = list(range(max_series - 1, -1, -1))
+        self.rejected = 0
+        self.evicted = 0
+        # Called with the series ID when a series is evicted, so the owners of per-series state can reset it
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def lookup(self, key):
+        # Returns the series ID for key (registering it if needed), or None if the registry is full
+        now = time.monotonic()
+        with self.lock:
+            series_id = self.pinned.get(key)
+            if series_id is not None:
+                return series_id
+            series_id = self.ids.get(key)
+            if series_id is not None:
+                self.ids.move_to_end(key)
+                self.last_seen[series_id] = now
+                return series_id
+
+            series_id = self._allocate(key, now)
+            if series_id is not None:
+                self.ids[key] = series_id
+            return series_id
+
+    def intern(self, key):
+        # Like lookup(), and pins the series until release()
+        with self.lock:
+            series_id = self.pinned.get(key)
+            if series_id is None:
+                series_id = self.ids.pop(key, None)
+                if series_id is None:
+                    series_id = self._allocate(key, time.monotonic())
+                    if series_id is None:
+                        return None
+                self.pinned[key] = series_id
+            self.pins[series_id] += 1
+            return series_id
+
+    def release(self, series_id):
+        with self.lock:
+            self.pins[series_id] -= 1
+            if self.pins[series_id] == 0:
+                # Evictable again once it has not been seen for ttl seconds
+                key = self.keys[series_id]
+                del self.pinned[key]
+                self.ids[key] = series_id
+                self.last_seen[series_id] = time.monotonic()
+
+    def key(self, series_id):
+        return self.keys[series_id]
+
+    def _allocate(self, key, now):
+        # Called with the lock held
+        if not self.free_ids:
+            self._evict_expired(now)
+        if not self.free_ids:
+            self.rejected += 1
+            if self.rejected % 1000 == 1:
+                logger.warning(f'Series limit ({self.max_series}) reached, rejected series {key} '
+                               f'({self.rejected} rejected so far)')
+            return None
+
+        series_id = self.free_ids.pop()
+        self.keys[series_id] = key
+        self.last_seen[series_id] = now
+        return series_id
+
+    def _evict_expired(self, now):
+        expired_before = now - self.ttl
+        while self.ids:
+            key, series_id = next(iter(self.ids.items()))
+            if self.last_seen[series_id] > expired_before:
+                break
+            del self.ids[key]
+            self.keys[series_id] = None
+            self.free_ids.append(series_id)
+            self.evicted += 1
+            for listener in self.listeners:
+                listener(series_id)
+            logger.debug('Evicted series %s (ID %d)', key, series_id)
+
+    def stats(self):
+        with self.lock:
+            return {'series': len(self.ids) + len(self.pinned), 'pinned': len(self.pinned),
+                    'max_series': self.max_series, 'rejected': self.rejected, 'evicted': self.evicted}
+
+
+_registry = SeriesRegistry()
+
+
+def get_registry():
+    # The registry shared by the devices and sinks of this process
+    return _registry
+
+
+def configure(max_series=10000, ttl=86400):
+    # Replace the shared registry, before any device or sink is started
+    global _registry
+    _registry = SeriesRegistry(max_series, ttl)
+
+
+class SeriesCache:
+    """
+    Series IDs of one source (device), interned on first use and released by release() when the source stops.
+    Sources with a fixed table of series (e.g. the DSMR OBIS codes) can cache the IDs by table index with slot().
+    """
+    def __init__(self, registry=None, slots=0):
+        self.registry = registry or get_registry()
+        self.ids = {}
+        self.slots = [None] * slots
+
+    def get(self, key):
+        # Returns None when the registry is full (retried on the next reading)
+        series_id = self.ids.get(key)
+        if series_id is None:
+            series_id = self.registry.intern(key)
+            if series_id is not None:
+                self.ids[key] = series_id
+        return series_id
+
+    def slot(self, index, key):
+        series_id = self.slots[index]
+        if series_id is None:
+            series_id = self.slots[index] = self.get(key)
+        return series_id
+
+    def release(self):
+        for series_id in self.ids.values():
+            self.registry.release(series_id)
+        self.ids = {}
+        self.slots = [None] * len(self.slots)
+
+
+class SeriesThrottle:
+    # Message rate throttle state of a sink: timestamp of the last message sent per series, indexed by series ID.
+    # The sinks index last_ts directly, it is reset when a series is evicted.
+    def __init__(self, registry):
+        self.registry = registry
+        # UNIX epoch (seconds) of the last message sent, 0 if none was sent yet
+        self.last_ts = array('q', [0]) * registry.max_series
+        registry.add_listener(self.reset)
+
+    def reset(self, series_id):
+        self.last_ts[series_id] = 0
+
+    def close(self):
+        self.registry.remove_listener(self.reset)
+
+
+class SeriesRates:
+    """
+    Message rate (messages per hour) of a sink per series ID: the device's rate, or its [RATES] override. Resolved on
+    first sight of a series ID, so the override key is only built once per series, and reset when the series is
+    evicted or the overrides change.
+    """
+    def __init__(self, registry, overrides=None):
+        self.registry = registry
+        self.overrides = overrides or {}
+        # -1 if not resolved yet. The sinks index rates directly.
+        self.rates = array('i', [-1]) * registry.max_series
+        registry.add_listener(self.reset)
+
+    def reset(self, series_id):
+        self.rates[series_id] = -1
+
+    def set_overrides(self, overrides):
+        # Called from the sink's own thread: the rates are reset in place
+        self.overrides = overrides
+        self.rates[:] = array('i', [-1]) * len(self.rates)
+
+    def resolve(self, item):
+        # Rate of the reading item, for readings without a series ID (or when its ID is not resolved yet)
+        message_rate = int(item[4])
+        if self.overrides:
+            message_rate = self.overrides.get(f'{item[0]}/{item[1]}/{item[2]}'.lower(), message_rate)
+        return message_rate
+
+    def close(self):
+        self.registry.remove_listener(self.reset)
@@ -0,0 +1,126 @@
+import pytest
+
+import aggregator
+from series import SeriesRegistry
+
+_TIMESTAMP = 1647345600123456789
+_READINGS = [['dsmr', 'el', 'el_consumed', 621230.0, _TIMESTAMP], ['solar', 'metrics', 'active_power', 4015, _TIMESTAMP]]
+
+
+@pytest.fixture
+def server():
+    server = aggregator.AggregatorServer('127.0.0.1:0', 'http://127.0.0.1:1', 'token', 'org', 'bucket',
+                                         batch_size=100, max_buffer=5, series=SeriesRegistry(100))
+    yield server
+    server.client.close()
+
+
+def test_frame_round_trip():
+    frame = aggregator.encode_frame('site1', 1647345600, 42, _READINGS)
+    assert aggregator.decode_frame(frame) == ('site1', 1647345600, 42, _READINGS)
+
+
+def test_version_1_frame():
+    # Older edges send timestamps in seconds
+    frame = bytearray(aggregator.encode_frame('site1', 1, 42, [['dsmr', 'el', 'el_consumed', 1.0, 1647345600]]))
+    frame[2] = 1
+    assert aggregator.decode_frame(frame)[3] == [['dsmr', 'el', 'el_consumed', 1.0, 1647345600000000000]]
+
+
+@pytest.mark.parametrize('precision, timestamp', [('ns', _TIMESTAMP), ('s', 1647345600)])
+def test_lines(precision, timestamp):
+    server = aggregator.AggregatorServer('127.0.0.1:0', 'http://127.0.0.1:1', 'token', 'org', 'bucket',
+                                         series=SeriesRegistry(100), precision=precision)
+    server.accept(aggregator.encode_frame('site 1', 1, 1, _READINGS + [['dsmr', 'el', 'x', float('nan'), 1]]), 'test')
+    assert list(server.lines) == [
+        f'dsmr_el,location=lt,site=site\\ 1 el_consumed=621230.0 {timestamp}',
+        f'solar_metrics,location=lt,site=site\\ 1 active_power=4015i {timestamp}',
+    ]
+    server.client.close()
+
+
+@pytest.mark.parametrize('frame', [
+    b'EL',
+    b'XX' + aggregator.encode_frame('site1', 1, 1, _READINGS)[2:],
+    aggregator.encode_frame('site1', 1, 1, _READINGS)[:-4],
+    aggregator.encode_frame('site1', 1, 1, [['dsmr', 'el', 'x', 1.0]]),
+    aggregator.encode_frame('site1', 1, 1, [['dsmr', 'el', 'x', None, 1647345600]]),
+    aggregator.encode_frame('site1', 1, 1, [['dsmr', 'el', 'x', 1.0, '1647345600']]),
+    aggregator.encode_frame('site1', 1, 1, [{'prefix': 'dsmr'}]),
+])
+def test_invalid_frame(server, frame):
+    with pytest.raises(aggregator.FrameError):
+        aggregator.decode_frame(frame)
+    assert server.accept(frame, 'test') == (aggregator.ACK_INVALID, 0)
+    assert server.sites == {}
+
+
+def test_duplicate_frames(server):
+    frame = aggregator.encode_frame('site1', 1647345600, 1, _READINGS)
+    assert server.accept(frame, 'test') == (aggregator.ACK_OK, 1)
+    assert len(server.lines) == 2
+
+    # Retransmission (lost ack): acknowledged, not written again
+    assert server.accept(frame, 'test') == (aggregator.ACK_OK, 1)
+    assert len(server.lines) == 2
+    assert server.accept(aggregator.encode_frame('site1', 1647345600, 2, _READINGS), 'test') == (aggregator.ACK_OK, 2)
+    assert len(server.lines) == 4
+
+
+def test_reboot_with_earlier_clock(server):
+    server.accept(aggregator.encode_frame('site1', 1647345600, 10, _READINGS), 'test')
+    server.lines.clear()
+    # A rebooted edge starts a new sequence, even when its clock (boot ID) went back
+    assert server.accept(aggregator.encode_frame('site1', 1000, 1, _READINGS), 'test') == (aggregator.ACK_OK, 1)
+    assert len(server.lines) == 2
+
+
+def test_wrong_shard():
+    server = aggregator.AggregatorServer('127.0.0.1:0', 'http://127.0.0.1:1', 'token', 'org', 'bucket',
+                                         shard_index=1, shard_count=2)
+    site = next(f'site{index}' for index in range(100) if aggregator.site_shard(f'site{index}', 2) == 0)
+    frame = aggregator.encode_frame(site, 1, 7, _READINGS)
+    assert server.accept(frame, 'test') == (aggregator.ACK_WRONG_SHARD, 7)
+    assert len(server.lines) == 0
+    server.client.close()
+
+
+def test_buffer_full(server):
+    for seq in range(1, 3):
+        assert server.accept(aggregator.encode_frame('site1', 1, seq, _READINGS), 'test') == (aggregator.ACK_OK, seq)
+    # No room for another frame: the edge keeps it and sends it again later
+    frame = aggregator.encode_frame('site1', 1, 3, _READINGS)
+    assert server.accept(frame, 'test') == (aggregator.ACK_BUSY, 3)
+    assert len(server.lines) == 4
+    assert server.refused == 1
+
+    server.lines.clear()
+    assert server.accept(frame, 'test') == (aggregator.ACK_OK, 3)
+    assert len(server.lines) == 2
+
+
+def test_buffer_full_mqtt(server):
+    # Frames received over MQTT cannot be refused
+    for seq in range(1, 4):
+        server.accept(aggregator.encode_frame('site1', 1, seq, _READINGS), 'test', defer=False)
+    assert len(server.lines) == 6
+    assert server.buffer_full()
+
+
+def test_failed_flush_is_retried(server):
+    server.accept(aggregator.encode_frame('site1', 1, 1, _READINGS), 'test')
+    lines = list(server.lines)
+    # InfluxDB is unreachable: the lines stay buffered for the next flush
+    assert not server.flush()
+    assert list(server.lines) == lines
+
+
+def test_flush_in_batches(server):
+    batches = []
+    server.write = lambda lines: batches.append(lines) or True
+    server.batch_size = 3
+    for seq in range(1, 3):
+        server.accept(aggregator.encode_frame('site1', 1, seq, _READINGS), 'test')
+    assert server.flush()
+    assert [len(batch) for batch in batches] == [3, 1]
+    assert len(server.lines) == 0
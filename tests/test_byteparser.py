@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from devices.dsmr import byteparser
+from devices.dsmr.simulator import load_telegrams
+from devices.dsmr.smartmeter import DSMRMeter
+from series import SeriesCache, SeriesRegistry
+
+_TELEGRAM = os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'telegram.txt')
+_TIMESTAMP = 1647345600123456789
+
+# Lines the parsers must skip or pass on as errors in the same way
+_MALFORMED = [
+    b'1-0:99.99.9(123)',           # unknown OBIS code
+    b'garbage without parentheses',
+    b'0-0:96.1.1()',               # empty value of a validated field
+    b'1-0:1.8.2(000000.000*kWh)',  # zero value of a validated field
+    b'1-0:1.7.0(12a.4*kW)',        # not a number
+    b'1-0:32.7.0(232.8)',          # unit missing
+    b'1-0:31.7.0(000.4',           # truncated
+]
+
+
+class _ListQueue(list):
+    put = list.append
+
+
+@pytest.fixture
+def meter():
+    meter = DSMRMeter(_ListQueue(), None)
+    meter.series = SeriesCache(SeriesRegistry(100), slots=byteparser.SERIES_SLOTS)
+    return meter
+
+
+def parse_text(meter, raw):
+    # Same steps as DSMRMeter.read_telegram() + run() in text mode
+    meter.queue.clear()
+    telegram = meter.preprocess(raw.decode('ascii'))
+    for item in telegram.splitlines():
+        meter.parse_telegram(item, _TIMESTAMP)
+    return list(meter.queue)
+
+
+def parse_bytes(meter, raw):
+    return byteparser.parse_telegram(bytearray(raw), timestamp=_TIMESTAMP, series=meter.series)
+
+
+def with_lines(raw, lines):
+    # Insert lines in front of the checksum line
+    checksum = raw.rindex(b'!')
+    return raw[:checksum] + b''.join(line + b'\r\n' for line in lines) + raw[checksum:]
+
+
+def test_recorded_telegram(meter):
+    raw, = load_telegrams(_TELEGRAM)
+    readings = parse_bytes(meter, raw)
+    assert readings == parse_text(meter, raw)
+
+    by_code = {(topic, tag): value for prefix, topic, tag, value, rate, timestamp, series_id in readings}
+    assert len(readings) == len(by_code)
+    assert all(reading[5] == _TIMESTAMP for reading in readings)
+    # Virtual totals of the tariff registers, in Wh
+    assert by_code[('el', 'el_consumed')] == 621230.0
+    assert by_code[('el', 'el_returned')] == 286465.0
+
+
+@pytest.mark.parametrize('line', _MALFORMED)
+def test_malformed_line(meter, line):
+    raw, = load_telegrams(_TELEGRAM)
+    raw = with_lines(raw, [line])
+    assert parse_bytes(meter, raw) == parse_text(meter, raw)
+
+
+def test_series_ids(meter):
+    raw, = load_telegrams(_TELEGRAM)
+    readings = parse_bytes(meter, raw)
+    for prefix, topic, tag, value, rate, timestamp, series_id in readings:
+        if int(rate) == 0:
+            assert series_id is None
+        else:
+            assert meter.series.registry.key(series_id) == (prefix, topic, tag)
@@ -0,0 +1,101 @@
+import time
+import queue
+
+import pytest
+
+import aggregator
+import dataloggers
+from series import SeriesRegistry
+
+_TIMESTAMP = 1647345600123456789
+
+
+def make_influx(**kwargs):
+    influx = dataloggers.InfluxLogger(queue.Queue(), 'http://127.0.0.1:1', 'token', 'org', 'bucket',
+                                      series=SeriesRegistry(100), flush_interval=0.01, **kwargs)
+    influx.written = []
+    influx.write = lambda lines: influx.written.extend(lines) or True
+    return influx
+
+
+def run(sink, items):
+    # Feed the items to the sink thread, and stop it once it has taken them all
+    for item in items:
+        sink.queue.put(item)
+    sink.start()
+    deadline = time.monotonic() + 5
+    while not sink.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    sink.stop()
+    sink.join(5)
+
+
+@pytest.fixture
+def influx():
+    influx = make_influx()
+    yield influx
+    influx.client.close()
+
+
+def test_rate_overrides(influx):
+    registry = influx.series
+    power = registry.intern(('dsmr', 'el', 'power'))
+    influx.set_rate_overrides({'dsmr/el/power': 0, 'dsmr/system/version': 60})
+    run(influx, [
+        # Interned, disabled by its override
+        ['dsmr', 'el', 'power', 1.0, '3600', _TIMESTAMP, power],
+        # Rate 0 definition (not interned), enabled by its override
+        ['dsmr', 'system', 'version', '50217', '0', _TIMESTAMP, None],
+        # Rate 0 without override
+        ['dsmr', 'system', 'provider', 'FLU5', '0', _TIMESTAMP, None],
+    ])
+    assert influx.written == [f'dsmr_system,location=lt version="50217" {_TIMESTAMP}']
+
+
+@pytest.mark.parametrize('precision, timestamp', [('ns', _TIMESTAMP), ('us', 1647345600123456),
+                                                  ('ms', 1647345600123), ('s', 1647345600)])
+def test_precision(precision, timestamp):
+    influx = make_influx(precision=precision)
+    run(influx, [['dsmr', 'el', 'power', 1.5, '3600', _TIMESTAMP, None],
+                 ['dsmr', 'el', 'nan', float('nan'), '3600', _TIMESTAMP, None]])
+    assert influx.written == [f'dsmr_el,location=lt power=1.5 {timestamp}']
+    influx.client.close()
+
+
+def test_retry_and_max_buffer():
+    influx = make_influx(batch_size=5, max_buffer=3)
+    attempts = []
+
+    def write(lines):
+        # InfluxDB is unreachable on the first attempt
+        attempts.append(list(lines))
+        return len(attempts) > 1
+    influx.write = write
+    items = [['dsmr', 'el', f'tag{index}', float(index), '3600', _TIMESTAMP, None] for index in range(5)]
+    for item in items:
+        influx.queue.put(item)
+    influx.start()
+    deadline = time.monotonic() + 5
+    while len(attempts) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    influx.stop()
+    influx.join(5)
+
+    # The failed batch is kept for the retry (after a 1 s backoff), minus the oldest lines that don't fit max_buffer
+    assert [len(lines) for lines in attempts] == [5, 3]
+    assert attempts[1] == attempts[0][2:]
+    assert influx.dropped == 2
+    influx.client.close()
+
+
+def test_forward_timestamps():
+    forward = dataloggers.ForwardLogger(queue.Queue(), 'site1', centrals=[('127.0.0.1', 1)], batch_size=2,
+                                        series=SeriesRegistry(100))
+    frames = []
+    forward._send_tcp = lambda seq, frame: frames.append(frame) or True
+    run(forward, [['dsmr', 'el', 'power', 1.5, '3600', _TIMESTAMP, None],
+                  ['dsmr', 'el', 'voltage', 230.1, '3600', _TIMESTAMP + 1, None]])
+    # Frame timestamps keep the reading's nanoseconds
+    site, boot_id, seq, readings = aggregator.decode_frame(frames[0])
+    assert readings == [['dsmr', 'el', 'power', 1.5, _TIMESTAMP], ['dsmr', 'el', 'voltage', 230.1, _TIMESTAMP + 1]]
@@ -0,0 +1,172 @@
+import logging
+import configparser
+
+import pytest
+
+import energylogger
+
+
+class _FakeThread:
+    def __init__(self, name, port=None, **kwargs):
+        self.name = name
+        self.port = port
+        self.kwargs = kwargs
+        self.rate_overrides = None
+        self.stopped = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return not self.stopped
+
+    def set_rate_overrides(self, rate_overrides):
+        self.rate_overrides = rate_overrides
+
+
+class _Started(dict):
+    # Threads started by apply_config by name, the threads started at boot (boot) and the names that fail (failing)
+    def __init__(self):
+        super().__init__()
+        self.boot = {}
+        self.failing = set()
+
+
+class _FakeMeters(_FakeThread):
+    def set_meters(self, meters):
+        self.port = meters
+
+
+_CONFIG = {
+    'MQTT': {'server': 'broker', 'port': '1883', 'user': 'u', 'password': 'p%%w'},
+    'INFLUXDB': {'url': 'http://influx:8086', 'token': 't', 'org': 'o', 'bucketid': 'b'},
+    'DEVICES': {'dsmrport': '/dev/ttyUSB0', 'sun2kport': '/dev/ttyUSB1', 'p1network': 'a=10.0.0.1:2001'},
+}
+
+
+def make_config(**changes):
+    # changes: section -> {option: value}, or None to remove the section
+    config = configparser.ConfigParser()
+    for section, options in _CONFIG.items():
+        config[section] = options
+    for section, options in changes.items():
+        if options is None:
+            config.remove_section(section)
+        else:
+            if not config.has_section(section):
+                config.add_section(section)
+            for option, value in options.items():
+                config[section][option] = value
+    return config
+
+
+@pytest.fixture
+def started(monkeypatch):
+    started = _Started()
+    failing = started.failing
+
+    def sink(name):
+        def start(_q, config):
+            if name in failing:
+                raise OSError(f'{name} is unreachable')
+            started[name] = _FakeThread(name)
+            return started[name]
+        return start
+
+    def device(name, cls=_FakeThread):
+        def create(_q, port, **kwargs):
+            if name in failing:
+                raise OSError(f'{port} does not exist')
+            started[name] = cls(name, port, **kwargs)
+            return started[name]
+        return create
+
+    monkeypatch.setattr(energylogger, '_SINKS', {
+        'mqtt': (('MQTT',), sink('mqtt')),
+        'influx': (('INFLUXDB',), sink('influx')),
+    })
+    monkeypatch.setattr(energylogger, '_DEVICES', {
+        'dsmrport': device('dsmrport'),
+        'sun2kport': device('sun2kport'),
+        'p1network': device('p1network', _FakeMeters),
+    })
+    monkeypatch.setattr(energylogger, '_threads', {})
+    monkeypatch.setattr(energylogger, '_applied', {})
+
+    # Same as main()
+    config = make_config()
+    monkeypatch.setattr(energylogger, '_config', config)
+    for name, (sections, start) in energylogger._SINKS.items():
+        energylogger._threads[name] = start(None, config)
+        energylogger._applied[name] = config
+    for option in energylogger._DEVICES:
+        energylogger._threads[option] = energylogger.start_device(None, config, option, config['DEVICES'][option])
+        energylogger._applied[option] = config
+    started.boot = dict(started)
+    started.clear()
+    return started
+
+
+def test_unchanged(started):
+    energylogger.apply_config(None, make_config(RATES={'dsmr/el/power': '60'}))
+    assert started == {}
+    assert started.boot['mqtt'].rate_overrides == {'dsmr/el/power': 60}
+
+
+def test_changed_sections_only(started):
+    energylogger.apply_config(None, make_config(MQTT={'server': 'other'}, DEVICES={'sun2kport': 'tcp://inverter'}))
+    assert set(started) == {'mqtt', 'sun2kport'}
+    assert started.boot['mqtt'].stopped and started.boot['sun2kport'].stopped
+    assert not started.boot['influx'].stopped and not started.boot['dsmrport'].stopped
+    assert started['sun2kport'].port == 'tcp://inverter'
+
+
+def test_device_options(started):
+    energylogger.apply_config(None, make_config(DEVICES={'dsmrparser': 'bytes'}))
+    assert set(started) == {'dsmrport'}
+    assert started['dsmrport'].kwargs == {'parser': 'bytes'}
+
+
+def test_removed(started):
+    energylogger.apply_config(None, make_config(INFLUXDB=None, DEVICES={'dsmrport': ''}))
+    assert started == {}
+    assert started.boot['influx'].stopped and started.boot['dsmrport'].stopped
+    assert set(energylogger._threads) == {'mqtt', 'sun2kport', 'p1network'}
+
+
+def test_p1_meters_updated_in_place(started):
+    energylogger.apply_config(None, make_config(DEVICES={'p1network': 'a=10.0.0.1:2001, b=10.0.0.2:2001'}))
+    assert started == {}
+    assert started.boot['p1network'].port == 'a=10.0.0.1:2001, b=10.0.0.2:2001'
+
+
+def test_failed_start(started):
+    # The influx sink fails to start: the other changes are still applied
+    started.failing.add('influx')
+    config = make_config(INFLUXDB={'url': 'http://other:8086'}, DEVICES={'dsmrport': '/dev/ttyUSB2'})
+    energylogger.apply_config(None, config)
+    assert set(started) == {'dsmrport'}
+    assert 'influx' not in energylogger._threads
+
+    # ... and influx is retried on the next change, without restarting the device that already switched
+    started.failing.clear()
+    started.clear()
+    energylogger.apply_config(None, make_config(INFLUXDB={'url': 'http://other:8086'},
+                                                DEVICES={'dsmrport': '/dev/ttyUSB2'}, RATES={'a/b/c': '1'}))
+    assert set(started) == {'influx'}
+
+
+def test_restart_sections(started, caplog):
+    with caplog.at_level(logging.WARNING):
+        energylogger.apply_config(None, make_config(SERIES={'maxseries': '5'}))
+    assert 'SERIES settings changed, restart EnergyLogger to apply them' in caplog.text
+    assert started == {}
+    assert not energylogger._config.has_section('SERIES')
+    # Values are copied raw, not interpolated twice
+    assert energylogger._config['MQTT']['password'] == 'p%w'
@@ -0,0 +1,25 @@
+import pytest
+from influxdb_client import Point, WritePrecision
+
+import lineprotocol
+
+
+@pytest.mark.parametrize('value', [1.5, 0.1 + 0.2, -3.0, 1e-7, 12, -1, True, False, 'FLU5\\253769484_A', 'a "b" c', ''])
+def test_same_as_point(value):
+    # Same lines as influxdb_client's Point, which the sinks used before
+    expected = Point('dsmr_el').tag('location', 'lt').field('el consumed,1=x', value) \
+        .time(1647345600123456789, WritePrecision.NS).to_line_protocol()
+    line = f'{lineprotocol.line_prefix("dsmr", "el", "el consumed,1=x")}{lineprotocol.format_value(value)} ' \
+        f'1647345600123456789'
+    assert line == expected
+
+
+def test_site_tag():
+    expected = Point('solar_metrics').tag('location', 'lt').tag('site', 'site 1,a=b').field('active_power', 1.0) \
+        .time(1647345600, WritePrecision.S).to_line_protocol()
+    assert f'{lineprotocol.line_prefix("solar", "metrics", "active_power", "site 1,a=b")}1.0 1647345600' == expected
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), float('-inf')])
+def test_unwritable_values(value):
+    assert lineprotocol.format_value(value) is None
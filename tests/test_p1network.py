@@ -0,0 +1,116 @@
+import os
+import time
+import queue
+import socket
+
+import pytest
+
+from devices.dsmr import byteparser
+from devices.dsmr.p1network import P1NetworkMeters, parse_meters
+from devices.dsmr.simulator import P1Simulator, load_telegrams
+
+_TELEGRAM = os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'telegram.txt')
+
+
+class _Simulator(P1Simulator):
+    # Counts the accepted connections
+    def process_request(self, request, client_address):
+        self.connection_count += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture
+def simulators():
+    simulators = []
+    for _ in range(2):
+        simulator = _Simulator(_TELEGRAM, interval=0.05)
+        simulator.connection_count = 0
+        simulator.start()
+        simulators.append(simulator)
+    yield simulators
+    for simulator in simulators:
+        simulator.shutdown()
+        simulator.server_close()
+
+
+@pytest.fixture
+def readings():
+    return queue.Queue()
+
+
+@pytest.fixture
+def reader(readings):
+    readers = []
+
+    def start(meters):
+        reader = P1NetworkMeters(readings, meters)
+        reader.start()
+        readers.append(reader)
+        return reader
+    yield start
+    for reader in readers:
+        reader.stop()
+        reader.join(5)
+
+
+def prefixes(readings, seconds=0.5):
+    # Prefixes of the readings received in the next seconds
+    while not readings.empty():
+        readings.get()
+    received = set()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            received.add(readings.get(timeout=0.05)[0])
+        except queue.Empty:
+            pass
+    return received
+
+
+def test_parse_meters():
+    assert parse_meters('apt1=10.0.0.11:2001, apt2=[fd00::12]:2001, ') == \
+        {'apt1': ('10.0.0.11', 2001), 'apt2': ('fd00::12', 2001)}
+
+
+def test_readings(simulators, readings, reader):
+    reader({'apt1': ('localhost', simulators[0].port)})
+    reading = readings.get(timeout=5)
+    telegram, = load_telegrams(_TELEGRAM)
+    expected = byteparser.parse_telegram(telegram, 'dsmr_apt1', reading[5])
+    received = [reading] + [readings.get(timeout=5) for _ in range(len(expected) - 1)]
+    # Same readings as the parser, with series IDs
+    assert [item[:6] for item in received] == [item[:6] for item in expected]
+    assert all(item[6] is not None for item in received if int(item[4]) != 0)
+
+
+def test_set_meters(simulators, readings, reader):
+    first, second = simulators
+    p1 = reader({'apt1': ('127.0.0.1', first.port)})
+    assert prefixes(readings) == {'dsmr_apt1'}
+
+    p1.set_meters(f'apt1=127.0.0.1:{first.port}, apt2=127.0.0.1:{second.port}')
+    assert prefixes(readings) == {'dsmr_apt1', 'dsmr_apt2'}
+
+    p1.set_meters(f'apt2=127.0.0.1:{second.port}')
+    time.sleep(0.1)
+    assert prefixes(readings) == {'dsmr_apt2'}
+    # The other meters kept their connection
+    assert (first.connection_count, second.connection_count) == (1, 1)
+
+
+def test_unusable_address(simulators, readings, reader, monkeypatch):
+    # An address family the host cannot open (e.g. IPv6 without IPv6 support) fails that address only
+    getaddrinfo = socket.getaddrinfo
+    unusable = (-1, socket.SOCK_STREAM, 0, '', ('fd00::12', 2001))
+
+    def fake_getaddrinfo(host, port, *args, **kwargs):
+        if host == 'unusable':
+            return [unusable]
+        if host == 'dual':
+            return [unusable] + getaddrinfo('127.0.0.1', port, *args, **kwargs)
+        return getaddrinfo(host, port, *args, **kwargs)
+    monkeypatch.setattr(socket, 'getaddrinfo', fake_getaddrinfo)
+
+    p1 = reader({'bad': ('unusable', 2001), 'apt1': ('dual', simulators[0].port)})
+    assert prefixes(readings) == {'dsmr_apt1'}
+    assert p1.is_alive()
@@ -0,0 +1,81 @@
+from series import SeriesCache, SeriesRates, SeriesRegistry, SeriesThrottle
+
+
+def test_lookup():
+    registry = SeriesRegistry(4)
+    series_id = registry.lookup(('dsmr', 'el', 'power'))
+    assert registry.lookup(('dsmr', 'el', 'power')) == series_id
+    assert registry.lookup(('dsmr', 'el', 'voltage')) != series_id
+    assert registry.key(series_id) == ('dsmr', 'el', 'power')
+
+
+def test_eviction():
+    registry = SeriesRegistry(2, ttl=0)
+    throttle = SeriesThrottle(registry)
+    first = registry.lookup(('dsmr', 'el', 'a'))
+    second = registry.lookup(('dsmr', 'el', 'b'))
+    throttle.last_ts[first] = throttle.last_ts[second] = 1000
+
+    # Full: the expired series are evicted, their IDs reused and their state reset
+    third = registry.lookup(('dsmr', 'el', 'c'))
+    assert third in (first, second)
+    assert registry.key(third) == ('dsmr', 'el', 'c')
+    assert list(throttle.last_ts) == [0, 0]
+    assert registry.stats() == {'series': 1, 'pinned': 0, 'max_series': 2, 'rejected': 0, 'evicted': 2}
+    throttle.close()
+
+
+def test_rejection():
+    registry = SeriesRegistry(2)
+    registry.lookup(('dsmr', 'el', 'a'))
+    registry.lookup(('dsmr', 'el', 'b'))
+    # Nothing has expired yet (default ttl)
+    assert registry.lookup(('dsmr', 'el', 'c')) is None
+    assert registry.intern(('dsmr', 'el', 'c')) is None
+    assert registry.stats()['rejected'] == 2
+    assert registry.lookup(('dsmr', 'el', 'a')) is not None
+
+
+def test_interned_series_are_pinned():
+    registry = SeriesRegistry(2, ttl=0)
+    cache = SeriesCache(registry, slots=1)
+    pinned = cache.slot(0, ('dsmr', 'el', 'a'))
+    assert cache.get(('dsmr', 'el', 'a')) == pinned
+    assert registry.lookup(('dsmr', 'el', 'a')) == pinned
+    registry.lookup(('dsmr', 'el', 'b'))
+
+    # Only the unpinned series can be evicted
+    registry.lookup(('dsmr', 'el', 'c'))
+    assert registry.lookup(('dsmr', 'el', 'd')) is not None
+    assert registry.key(pinned) == ('dsmr', 'el', 'a')
+    assert registry.stats()['pinned'] == 1
+
+    # Released series are evicted like any other
+    cache.release()
+    assert cache.slots == [None]
+    assert registry.stats()['pinned'] == 0
+    registry.lookup(('dsmr', 'el', 'e'))
+    registry.lookup(('dsmr', 'el', 'f'))
+    assert registry.key(pinned) != ('dsmr', 'el', 'a')
+
+
+def test_rates():
+    registry = SeriesRegistry(2, ttl=0)
+    rates = SeriesRates(registry, {'dsmr/el/power': 60})
+    power = ['dsmr', 'el', 'Power', 1.0, '12', 0, None]
+    assert rates.resolve(power) == 60
+    assert rates.resolve(['dsmr', 'el', 'voltage', 1.0, '12', 0, None]) == 12
+    assert list(rates.rates) == [-1, -1]
+
+    # The sinks cache the resolved rate by series ID, until the overrides change or the series is evicted
+    series_id = registry.lookup(('dsmr', 'el', 'Power'))
+    rates.rates[series_id] = rates.resolve(power)
+    rates.set_overrides({})
+    assert rates.rates[series_id] == -1
+    assert rates.resolve(power) == 12
+
+    rates.rates[series_id] = 12
+    registry.lookup(('dsmr', 'el', 'a'))
+    registry.lookup(('dsmr', 'el', 'b'))
+    assert rates.rates[series_id] == -1
+    rates.close()
@@ -0,0 +1,88 @@
+import pytest
+
+import tracing
+
+
+@pytest.fixture(autouse=True)
+def histograms():
+    tracing.reset()
+    yield tracing._histograms
+    tracing.reset()
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(tracing, 'enabled', False)
+    reading = ['dsmr', 'el', 'power', 1.0, '12', 0, None]
+    assert tracing.acquired() is None
+    assert tracing.traced(reading, tracing.acquired()) == ['dsmr', 'el', 'power', 1.0, '12', 0, None]
+    assert tracing.dequeued(reading) is None
+    tracing.written(None, 'influx')
+
+
+def test_enabled(monkeypatch):
+    monkeypatch.setattr(tracing, 'enabled', True)
+    monkeypatch.setattr(tracing, 'now', lambda: 1000)
+    reading = tracing.traced(['dsmr', 'el', 'power', 1.0, '12', 0, None], tracing.acquired())
+    trace = tracing.get_trace(reading)
+    assert (trace.acquired, trace.queued) == (1000, 1000)
+    assert tracing.dequeued(reading) is trace
+
+
+def test_written_stages(monkeypatch, histograms):
+    trace = tracing.Trace(1000)
+    trace.queued = 3000
+    clock = iter([10000, 50000, 250000])
+    monkeypatch.setattr(tracing, 'now', lambda: next(clock))
+    tracing.dequeued([None] * 7 + [trace])
+    tracing.throttled(trace)
+    tracing.written(trace, 'influx')
+
+    assert {name: histogram.sum_ns for name, histogram in histograms.items()} == {
+        'influx: acquired->queued': 2000,
+        'influx: queue wait': 7000,
+        'influx: throttle': 40000,
+        'influx: write': 200000,
+        'influx: acquired->written': 249000,
+    }
+
+
+def test_written_without_throttle(monkeypatch, histograms):
+    # E.g. the forwarder's readings, written when they are batched
+    trace = tracing.Trace(0)
+    trace.queued = trace.dequeued = 5
+    monkeypatch.setattr(tracing, 'now', lambda: 10)
+    tracing.written(trace, 'forward')
+    assert sorted(histograms) == ['forward: acquired->queued', 'forward: acquired->written', 'forward: queue wait']
+
+
+@pytest.mark.parametrize('ns, bucket', [(0, 0), (1999, 0), (2000, 1), (3999, 1), (4000, 2), (1000000, 9),
+                                        (10 ** 15, tracing._BUCKETS - 1)])
+def test_histogram_buckets(ns, bucket):
+    histogram = tracing.LatencyHistogram()
+    histogram.observe(ns)
+    assert histogram.counts[bucket] == 1
+    # Upper bound (us) of the bucket
+    assert histogram.percentile(1.0) == 2 ** (bucket + 1)
+
+
+def test_histogram_summary():
+    histogram = tracing.LatencyHistogram()
+    assert histogram.summary() == 'no samples'
+    for us in [1] * 50 + [10] * 40 + [100] * 9 + [1000]:
+        histogram.observe(us * 1000)
+    assert histogram.total == 100
+    assert (histogram.percentile(0.5), histogram.percentile(0.9), histogram.percentile(0.99)) == (2, 16, 128)
+    assert histogram.summary() == 'n=100 mean=24us p50<2us p90<16us p99<128us max=1000us'
+
+
+def test_profiler(tmp_path):
+    output = tmp_path / 'profile.folded'
+    profiler = tracing.SamplingProfiler(0.001, str(output))
+    profiler.start()
+    while not profiler.stacks:
+        pass
+    profiler.stop()
+    profiler.join(5)
+    # Folded stacks: 'thread;file:function;... count'
+    lines = output.read_text().splitlines()
+    assert any(line.startswith('MainThread;') and 'test_tracing.py:test_profiler' in line for line in lines)
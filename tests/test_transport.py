@@ -0,0 +1,117 @@
+import queue
+import socket
+
+import pytest
+
+from devices.sun2000 import transport
+from devices.sun2000.simulator import ModbusTCPSimulator, default_registers
+from devices.sun2000.sun2000 import Sun2000
+
+
+class _Simulator(ModbusTCPSimulator):
+    # Keeps the accepted connections, so a test can drop them
+    def process_request(self, request, client_address):
+        self.connections.append(request)
+        super().process_request(request, client_address)
+
+    def drop_connections(self):
+        for request in self.connections:
+            request.shutdown(socket.SHUT_RDWR)
+
+
+class _BusyRegisters(dict):
+    # Answers the first `busy` reads of a register with a Modbus exception, like a busy SDongle
+    def __init__(self, registers, address, busy):
+        super().__init__(registers)
+        self.address = address
+        self.busy = busy
+
+    def __getitem__(self, address):
+        if address == self.address and self.busy:
+            self.busy -= 1
+            raise KeyError(address)
+        return super().__getitem__(address)
+
+
+@pytest.fixture
+def simulator(request):
+    simulator = _Simulator(registers=getattr(request, 'param', None))
+    simulator.connections = []
+    simulator.start()
+    yield simulator
+    simulator.shutdown()
+    simulator.server_close()
+
+
+@pytest.fixture
+def instrument(simulator):
+    instrument = transport.TCPTransport('127.0.0.1', simulator.port, connect_delay=0)
+    yield instrument
+    instrument.close()
+
+
+def test_read(instrument):
+    assert instrument.read_register(30070) == 428
+    assert instrument.read_register(32069, 1) == 233.1
+    assert instrument.read_long(32082, signed=True) == -120
+    assert instrument.read_string(30000, 15).rstrip('\x00') == 'SUN2000-5KTL-M1'
+
+
+def test_pipeline(instrument):
+    assert instrument.pipeline([(32069, 3, 3), (30071, 1, 3), (32106, 2, 3)]) == \
+        [(2331, 2318, 2342), (2,), (1234567 >> 16, 1234567 & 0xffff)]
+
+
+def test_modbus_exception(instrument):
+    with pytest.raises(transport.ModbusError):
+        instrument.read_register(40000)
+    assert instrument.pipeline([(40000, 1, 3), (30070, 1, 3)], raise_errors=False) == [None, (428,)]
+    # A Modbus exception keeps the connection
+    assert instrument.sock is not None
+
+
+def test_reconnect(simulator, instrument):
+    assert instrument.read_register(30070) == 428
+    simulator.drop_connections()
+    with pytest.raises((OSError, transport.ModbusError)):
+        instrument.read_register(30070)
+    assert instrument.sock is None
+
+    # The next request reconnects
+    assert instrument.read_register(30070) == 428
+    assert len(simulator.connections) == 2
+
+
+def test_sun2000_pipelined_metrics(simulator):
+    inverter = Sun2000(queue.Queue(), f'tcp://127.0.0.1:{simulator.port}')
+    inverter.instrument.connect_delay = 0
+    inverter.pv_string_count = inverter.get_pv_strings_number()
+    assert inverter.pipelined
+    assert inverter.get_metrics() == inverter.get_metrics_registers()
+    inverter.instrument.close()
+
+
+@pytest.mark.parametrize('simulator', [_BusyRegisters(default_registers(), 32106, 1)], indirect=True)
+def test_sun2000_metrics_retried(simulator):
+    inverter = Sun2000(queue.Queue(), f'tcp://127.0.0.1:{simulator.port}')
+    inverter.instrument.connect_delay = 0
+    inverter.pv_string_count = 2
+    # A transient Modbus exception retries the whole cycle, instead of logging a 0 total
+    assert inverter.get_metrics()['total_power'] == 1234567
+    inverter.instrument.close()
+
+
+@pytest.mark.parametrize('simulator', [_BusyRegisters(default_registers(), 32106, 1000)], indirect=True)
+def test_sun2000_metrics_skipped(simulator):
+    readings = queue.Queue()
+    inverter = Sun2000(readings, f'tcp://127.0.0.1:{simulator.port}')
+    inverter.instrument.connect_delay = 0
+    inverter.retry_count = 2
+    inverter.start()
+    # The system readings are logged, the metrics cycle that kept failing is not
+    topics = {readings.get(timeout=5)[1] for _ in range(3)}
+    inverter.stop()
+    inverter.join(5)
+    while not readings.empty():
+        topics.add(readings.get()[1])
+    assert topics == {'system'}
@@ -0,0 +1,60 @@
+import pytest
+
+import tracing
+import workers
+
+
+@pytest.fixture
+def ring():
+    ring = workers.RingBuffer(4)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_round_trip(ring):
+    trace = tracing.Trace(123)
+    trace.queued = 456
+    items = [
+        ['dsmr', 'el', 'el_consumed', 621230.0, '12', 1647345600123456789, 3],
+        ['solar', 'system', 'status_code', 512, 3600, 1647345600000000000, None],
+        ['dsmr', 'el', 'serial', 'ÿ€ 3153414733313031303231363035', '1', 1, 7, trace],
+    ]
+    for item in items:
+        assert ring.put(item)
+
+    received = ring.get_all()
+    # Series IDs are local to a process and not stored, the message rate comes back as an int
+    assert [item[:4] for item in received] == [item[:4] for item in items]
+    assert [item[4] for item in received] == [12, 3600, 1]
+    assert [item[5] for item in received] == [item[5] for item in items]
+    assert [item[6] for item in received] == [None, None, None]
+    assert tracing.get_trace(received[0]) is None
+    assert (received[2][7].acquired, received[2][7].queued) == (123, 456)
+    assert ring.get_all() == []
+
+
+def test_overflow(ring):
+    for value in range(6):
+        ring.put(['dsmr', 'el', 'power', float(value), 1, value, None])
+    # The reader never blocks: readings that don't fit are dropped
+    assert ring.dropped == 2
+    assert [item[3] for item in ring.get_all()] == [0.0, 1.0, 2.0, 3.0]
+
+    # Wraps around once the consumer has caught up
+    for value in range(6, 9):
+        assert ring.put(['dsmr', 'el', 'power', float(value), 1, value, None])
+    assert [item[3] for item in ring.get_all()] == [6.0, 7.0, 8.0]
+
+
+@pytest.mark.parametrize('item', [
+    ['x' * (workers.PREFIX_SIZE + 1), 'el', 'power', 1.0, 1, 0, None],
+    ['dsmr', 'é' * workers.TOPIC_SIZE, 'power', 1.0, 1, 0, None],
+    ['dsmr', 'el', 't' * (workers.TAG_SIZE + 1), 1.0, 1, 0, None],
+    ['dsmr', 'el', 'serial', 'v' * (workers.STR_VALUE_SIZE + 1), 1, 0, None],
+])
+def test_reject_long_fields(ring, item):
+    # Would be truncated (and merged with other series) by struct
+    assert not ring.put(item)
+    assert ring.rejected == 1
+    assert ring.get_all() == []
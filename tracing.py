@@ -0,0 +1,234 @@
+"""
+Pipeline latency tracing and an opt-in sampling profiler.
+
+When tracing is enabled, devices attach a Trace to each reading (as its eighth list element) carrying per-stage
+timestamps: acquired (telegram read / registers polled), queued (reading put on the queue), dequeued (taken by a
+sink), throttled (passed the message rate throttle) and written (sent by the sink). Sinks record the stage
+latencies into histograms. When tracing is disabled, no Trace is created and readings are unchanged.
+
+Both tracing and the profiler can be toggled at runtime with signals (see install_signal_handlers):
+SIGUSR1 toggles tracing and logs the latency report, SIGUSR2 starts/stops the profiler and writes its report.
+"""
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+
+_lock = threading.Lock()
+_histograms = {}
+
+# Histogram buckets: powers of two in microseconds, 1 us up to ~8.6 minutes
+_BUCKETS = 30
+
+
+class Trace:
+    __slots__ = ('acquired', 'queued', 'dequeued', 'throttled')
+
+    def __init__(self, acquired):
+        self.acquired = acquired
+        self.queued = 0
+        self.dequeued = 0
+        self.throttled = 0
+
+
+def now():
+    # Monotonic and system-wide on Linux, so timestamps from reader processes can be compared in the sink process
+    return time.monotonic_ns()
+
+
+def acquired():
+    # Acquisition timestamp for the readings of a telegram or poll cycle, or None when tracing is disabled
+    if not enabled:
+        return None
+    return now()
+
+
+def traced(reading, acquired_at):
+    # Attach a trace to a reading (Format: [prefix, topic, tag, value, messagerate, timestamp, series ID, trace])
+    # and mark it as queued
+    if acquired_at is None:
+        return reading
+    trace = Trace(acquired_at)
+    trace.queued = now()
+    reading.append(trace)
+    return reading
+
+
+def get_trace(item):
+    return item[7] if len(item) > 7 else None
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.total = 0
+        self.sum_ns = 0
+        self.max_ns = 0
+
+    def observe(self, ns):
+        bucket = min(max(ns // 1000, 1).bit_length() - 1, _BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.total += 1
+        self.sum_ns += ns
+        self.max_ns = max(self.max_ns, ns)
+
+    def percentile(self, fraction):
+        # Upper bound (in us) of the bucket containing the percentile
+        threshold = fraction * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return 2 ** (bucket + 1)
+        return 2 ** _BUCKETS
+
+    def summary(self):
+        if not self.total:
+            return 'no samples'
+        return (f'n={self.total} mean={self.sum_ns / self.total / 1000:.0f}us p50<{self.percentile(0.5)}us '
+                f'p90<{self.percentile(0.9)}us p99<{self.percentile(0.99)}us max={self.max_ns / 1000:.0f}us')
+
+
+def observe(name, ns):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = LatencyHistogram()
+        histogram.observe(ns)
+
+
+def dequeued(item):
+    trace = get_trace(item)
+    if trace is not None:
+        trace.dequeued = now()
+    return trace
+
+
+def throttled(trace):
+    if trace is not None:
+        trace.throttled = now()
+
+
+def written(trace, sink):
+    # Record the stage latencies of a reading that was written by the given sink
+    if trace is None:
+        return
+    written_at = now()
+    observe(f'{sink}: acquired->queued', trace.queued - trace.acquired)
+    observe(f'{sink}: queue wait', trace.dequeued - trace.queued)
+    if trace.throttled:
+        observe(f'{sink}: throttle', trace.throttled - trace.dequeued)
+        observe(f'{sink}: write', written_at - trace.throttled)
+    observe(f'{sink}: acquired->written', written_at - trace.acquired)
+
+
+def report():
+    with _lock:
+        lines = [f'{name}: {histogram.summary()}' for name, histogram in sorted(_histograms.items())]
+    if not lines:
+        logger.info('Latency report: no traced readings')
+        return
+    logger.info('Latency report:\n  ' + '\n  '.join(lines))
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def set_enabled(value):
+    global enabled
+    enabled = value
+    logger.info(f'Latency tracing {"enabled" if value else "disabled"}')
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stacks of all threads at a fixed interval and counts them. The report is written in the folded
+    stack format ('frame;frame;frame count' per line) used by flame graph tools.
+    """
+    def __init__(self, interval=0.01, output='profile.folded'):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.output = output
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        logger.info(f'Sampling profiler started ({self.interval * 1000:.0f} ms interval)')
+        own_id = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+        with open(self.output, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write(f'{stack} {count}\n')
+        total = sum(self.stacks.values())
+        top = '\n  '.join(f'{count * 100 / total:5.1f}% {stack.rsplit(";", 1)[-1]} ({stack.split(";", 1)[0]})'
+                          for stack, count in self.stacks.most_common(10)) if total else 'no samples'
+        logger.info(f'Sampling profiler stopped, {total} samples written to {self.output}. Top stacks:\n  {top}')
+
+
+_profiler = None
+
+
+def toggle_profiler(interval=0.01, output='profile.folded'):
+    global _profiler
+    if _profiler is not None and _profiler.is_alive():
+        _profiler.stop()
+        _profiler = None
+    else:
+        _profiler = SamplingProfiler(interval, output)
+        _profiler.start()
+
+
+def install_signal_handlers(profile_interval=0.01, profile_output='profile.folded'):
+    # Must be called from the main thread
+    def on_sigusr1(signum, frame):
+        set_enabled(not enabled)
+        if not enabled:
+            report()
+            reset()
+
+    def on_sigusr2(signum, frame):
+        toggle_profiler(profile_interval, profile_output)
+
+    signal.signal(signal.SIGUSR1, on_sigusr1)
+    signal.signal(signal.SIGUSR2, on_sigusr2)
+
+
+class LatencyReporter(threading.Thread):
+    # Logs the latency report at a fixed interval while tracing is enabled
+    def __init__(self, interval=300):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            if enabled:
+                report()
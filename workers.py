@@ -0,0 +1,284 @@
+import os
+import time
+import struct
+import threading
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import tracing
+from series import SeriesCache
+
+logger = logging.getLogger(__name__)
+
+# Ring buffer header: head (next record to read, written by the consumer) and tail (next record to write, written
+# by the producer). Both only ever increase, the slot is the counter modulo the capacity. Followed by flags, written
+# by the consumer to pass settings to the producer process.
+_HEADER = struct.Struct('<QQQ')
+_HEAD_OFFSET = 0
+_TAIL_OFFSET = 8
+_FLAGS_OFFSET = 16
+_COUNTER = struct.Struct('<Q')
+_FLAG_TRACING = 1
+
+# Widths (bytes, UTF-8 encoded) of the string fields of a record. RingBuffer.put() rejects readings that don't fit.
+PREFIX_SIZE = 24
+TOPIC_SIZE = 24
+TAG_SIZE = 32
+STR_VALUE_SIZE = 256
+
+# Fixed-size reading record: prefix, topic, tag, value kind, float value, int value, str value, message rate,
+# timestamp, trace acquired and queued timestamps (0 when the reading is not traced)
+_RECORD = struct.Struct(f'<{PREFIX_SIZE}s{TOPIC_SIZE}s{TAG_SIZE}sBdq{STR_VALUE_SIZE}sIqqq')
+_KIND_FLOAT = 0
+_KIND_INT = 1
+_KIND_STR = 2
+
+# Worker restart backoff (seconds)
+_RESTART_BACKOFF_MIN = 1
+_RESTART_BACKOFF_MAX = 60
+
+# How often the supervisor drains the ring buffer (seconds)
+_DRAIN_INTERVAL = 0.01
+
+
+def parse_cpus(value):
+    # '0,1' or '2-3' -> {0, 1} / {2, 3}. An empty value means no pinning.
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def set_affinity(cpus):
+    if not cpus:
+        return
+    if not hasattr(os, 'sched_setaffinity'):
+        logger.warning('CPU affinity is not supported on this platform, ignoring')
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as err:
+        logger.warning(f'Unable to set CPU affinity to {sorted(cpus)}: {err}')
+
+
+class RingBuffer:
+    """
+    Single-producer/single-consumer ring buffer of fixed-size reading records in shared memory.
+    The device reader process is the producer (it uses the ring as its queue), the supervisor the consumer.
+    """
+    def __init__(self, capacity, name=None):
+        self.capacity = capacity
+        self.size = _HEADER.size + capacity * _RECORD.size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.size)
+            _HEADER.pack_into(self.shm.buf, 0, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.dropped = 0
+        self.rejected = 0
+
+    def put(self, item):
+        # Format: [prefix, topic, tag, value, messagerate, timestamp, series ID(, trace)] (list). Never blocks: when
+        # the consumer falls behind the reading is dropped, so acquisition timing does not depend on the sinks.
+        # Series IDs are local to a process and not stored.
+        head, tail, flags = _HEADER.unpack_from(self.buf, 0)
+        if tail - head >= self.capacity:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f'Ring buffer {self.name} full, {self.dropped} readings dropped so far')
+            return False
+
+        value = item[3]
+        float_val = 0.0
+        int_val = 0
+        str_val = b''
+        if isinstance(value, float):
+            kind = _KIND_FLOAT
+            float_val = value
+        elif isinstance(value, int):
+            kind = _KIND_INT
+            int_val = value
+        else:
+            kind = _KIND_STR
+            str_val = str(value).encode('utf-8')
+
+        # struct would silently truncate strings that don't fit their field (merging series, or cutting a value
+        # mid-character): reject the reading instead
+        prefix = item[0].encode('utf-8')
+        topic = item[1].encode('utf-8')
+        tag = item[2].encode('utf-8')
+        if len(prefix) > PREFIX_SIZE or len(topic) > TOPIC_SIZE or len(tag) > TAG_SIZE or \
+                len(str_val) > STR_VALUE_SIZE:
+            self.rejected += 1
+            if self.rejected % 1000 == 1:
+                logger.warning(f'Reading {item[0]}/{item[1]}/{item[2]} does not fit a ring buffer record, '
+                               f'{self.rejected} readings rejected so far')
+            return False
+
+        trace = tracing.get_trace(item)
+        offset = _HEADER.size + (tail % self.capacity) * _RECORD.size
+        _RECORD.pack_into(self.buf, offset,
+                          prefix, topic, tag, kind, float_val, int_val, str_val, int(item[4]), item[5],
+                          trace.acquired if trace else 0, trace.queued if trace else 0)
+        # Publish the record only after it has been written completely
+        _COUNTER.pack_into(self.buf, _TAIL_OFFSET, tail + 1)
+        return True
+
+    def get_all(self):
+        head, tail, flags = _HEADER.unpack_from(self.buf, 0)
+        items = []
+        while head < tail:
+            offset = _HEADER.size + (head % self.capacity) * _RECORD.size
+            prefix, topic, tag, kind, float_val, int_val, str_val, message_rate, timestamp, acquired, queued = \
+                _RECORD.unpack_from(self.buf, offset)
+            if kind == _KIND_FLOAT:
+                value = float_val
+            elif kind == _KIND_INT:
+                value = int_val
+            else:
+                value = str_val.rstrip(b'\0').decode('utf-8', 'replace')
+            item = [prefix.rstrip(b'\0').decode('utf-8'), topic.rstrip(b'\0').decode('utf-8'),
+                    tag.rstrip(b'\0').decode('utf-8'), value, message_rate, timestamp, None]
+            if acquired:
+                trace = tracing.Trace(acquired)
+                trace.queued = queued
+                item.append(trace)
+            items.append(item)
+            head += 1
+        _COUNTER.pack_into(self.buf, _HEAD_OFFSET, head)
+        return items
+
+    def get_flags(self):
+        return _COUNTER.unpack_from(self.buf, _FLAGS_OFFSET)[0]
+
+    def set_flags(self, flags):
+        _COUNTER.pack_into(self.buf, _FLAGS_OFFSET, flags)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def _reader_main(device_class, port, device_kwargs, ring_name, capacity, cpus, stop_event):
+    # Entry point of a reader process: runs a single device thread that writes into the shared ring buffer
+    logging.basicConfig(level=logging.INFO, encoding='utf-8', format='%(asctime)s: [%(module)s]: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    set_affinity(cpus)
+
+    ring = RingBuffer(capacity, name=ring_name)
+    t_device = device_class(ring, port, **device_kwargs)
+    t_device.daemon = True
+    t_device.start()
+
+    while t_device.is_alive() and not stop_event.wait(1):
+        # Follow the tracing setting of the sink process
+        tracing.enabled = bool(ring.get_flags() & _FLAG_TRACING)
+
+    crashed = not t_device.is_alive()
+    if crashed:
+        logger.error(f'{device_class.__name__} on {port} exited unexpectedly')
+    else:
+        t_device.stop()
+        t_device.join()
+    ring.close()
+    if crashed:
+        # Non-zero exit code, so the supervisor restarts the worker
+        os._exit(1)
+
+
+class ReaderSupervisor(threading.Thread):
+    """
+    Runs a device reader in its own process and forwards its readings from the shared ring buffer to the sink
+    queue. Crashed workers are restarted with an increasing backoff. Has the same stop() interface as the device
+    threads, so it can be managed the same way.
+    """
+    def __init__(self, queue, device_class, port, device_kwargs=None, capacity=4096, cpus=None):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.device_class = device_class
+        self.port = port
+        self.device_kwargs = device_kwargs or {}
+        self.capacity = capacity
+        self.cpus = cpus or set()
+        self.stop_event = threading.Event()
+        # Spawn instead of fork: the parent runs MQTT/Influx client threads that must not be duplicated
+        self.ctx = multiprocessing.get_context('spawn')
+        self.ring = RingBuffer(capacity)
+        # Series IDs of the readings in this (the sinks') process, interned once per series
+        self.series = SeriesCache()
+        self.process = None
+        self.worker_stop_event = None
+        self.started_at = 0
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _start_worker(self):
+        self.worker_stop_event = self.ctx.Event()
+        self.process = self.ctx.Process(
+            target=_reader_main,
+            args=(self.device_class, self.port, self.device_kwargs, self.ring.name, self.capacity, self.cpus,
+                  self.worker_stop_event),
+            name=f'{self.device_class.__name__}-{self.port}',
+            daemon=True,
+        )
+        self.process.start()
+        self.started_at = time.monotonic()
+        logger.info(f'Started {self.device_class.__name__} worker (pid {self.process.pid}) on {self.port}')
+
+    def _drain(self):
+        self.ring.set_flags(_FLAG_TRACING if tracing.enabled else 0)
+        for item in self.ring.get_all():
+            if item[4] != 0:
+                item[6] = self.series.get((item[0], item[1], item[2]))
+            self.queue.put(item)
+
+    def run(self):
+        self._start_worker()
+        backoff = _RESTART_BACKOFF_MIN
+        restart_at = None
+
+        while not self.stop_event.wait(_DRAIN_INTERVAL):
+            self._drain()
+
+            now = time.monotonic()
+            if self.process.is_alive():
+                # Reset the backoff once the worker has been running for a while
+                if now - self.started_at > _RESTART_BACKOFF_MAX:
+                    backoff = _RESTART_BACKOFF_MIN
+                continue
+
+            # Worker crashed: schedule a restart, the ring buffer (and its unread readings) survives the worker
+            if restart_at is None:
+                logger.error(f'{self.device_class.__name__} worker on {self.port} exited with code '
+                             f'{self.process.exitcode}, restarting in {backoff}s')
+                restart_at = now + backoff
+            elif now >= restart_at:
+                self._start_worker()
+                restart_at = None
+                backoff = min(backoff * 2, _RESTART_BACKOFF_MAX)
+
+        # Stop the worker gracefully, forcefully if it does not respond
+        self.worker_stop_event.set()
+        self.process.join(15)
+        if self.process.is_alive():
+            logger.warning(f'{self.device_class.__name__} worker on {self.port} did not stop, terminating')
+            self.process.terminate()
+            self.process.join()
+        self._drain()
+        self.ring.close()
+        self.ring.unlink()
+        self.series.release()
+        logger.info(f'{self.device_class.__name__} worker on {self.port} stopped')